@@ -30,7 +30,7 @@ signal.signal(signal.SIGTERM, do_exit)
 
 # program checks
 for prog in [
-    "bwrap", "scanelf", "openssl", "apk", "git", "tee"
+    "bwrap", "openssl", "apk", "git", "tee"
 ]:
     if not shutil.which(prog):
         sys.exit(f"Required program not found: {prog}")
@@ -46,6 +46,13 @@ opt_skipexist = False
 opt_check     = False
 opt_ccache    = False
 opt_makejobs  = 1
+opt_pkgjobs   = 1
+opt_overlay   = False
+opt_layercache = 0
+opt_compthreads = 1
+opt_compblock = 128
+opt_keepsame  = False
+opt_nocache   = False
 opt_nocolor   = "NO_COLOR" in os.environ
 opt_signkey   = None
 opt_unsigned  = False
@@ -74,6 +81,10 @@ parser.add_argument(
 parser.add_argument(
     "-j", "--jobs", help = "Number of jobs to use.", default = None
 )
+parser.add_argument(
+    "-J", "--pkg-jobs", default = None,
+    help = "Number of packages to build at the same time."
+)
 parser.add_argument(
     "-E", "--skip-if-exists", action = "store_const",
     const = True, default = opt_skipexist,
@@ -103,6 +114,11 @@ parser.add_argument(
     const = True, default = opt_mdirtemp,
     help = "Use a temporary masterdir to build."
 )
+parser.add_argument(
+    "--no-cache", action = "store_const",
+    const = True, default = opt_nocache,
+    help = "Parse templates again instead of using cached metadata."
+)
 parser.add_argument(
     "--allow-unsigned", action = "store_const",
     const = True, default = opt_unsigned,
@@ -129,6 +145,12 @@ if "build" in global_cfg:
     opt_ccache    = bcfg.getboolean("ccache", fallback = opt_ccache)
     opt_check     = bcfg.getboolean("check", fallback = opt_check)
     opt_makejobs  = bcfg.getint("jobs", fallback = opt_makejobs)
+    opt_pkgjobs   = bcfg.getint("pkg_jobs", fallback = opt_pkgjobs)
+    opt_overlay   = bcfg.getboolean("overlay", fallback = opt_overlay)
+    opt_layercache = bcfg.getint("layer_cache_size", fallback = opt_layercache)
+    opt_compthreads = bcfg.getint("compress_threads", fallback = opt_compthreads)
+    opt_compblock = bcfg.getint("compress_blocksize", fallback = opt_compblock)
+    opt_keepsame  = bcfg.getboolean("keep_identical", fallback = opt_keepsame)
     opt_cflags    = bcfg.get("cflags", fallback = opt_cflags)
     opt_cxxflags  = bcfg.get("cxxflags", fallback = opt_cxxflags)
     opt_ldflags   = bcfg.get("ldflags", fallback = opt_ldflags)
@@ -146,6 +168,9 @@ if "signing" in global_cfg:
 if cmdline.jobs:
     opt_makejobs = int(cmdline.jobs)
 
+if cmdline.pkg_jobs:
+    opt_pkgjobs = int(cmdline.pkg_jobs)
+
 if cmdline.build_dbg:
     opt_gen_dbg = True
 
@@ -164,6 +189,9 @@ if cmdline.skip_if_exists:
 if cmdline.check:
     opt_check = True
 
+if cmdline.no_cache:
+    opt_nocache = True
+
 if cmdline.masterdir:
     opt_masterdir = cmdline.masterdir
 
@@ -187,7 +215,9 @@ paths.init(os.path.dirname(__file__), opt_masterdir, opt_hostdir)
 
 from cbuild.util import make
 from cbuild.core import chroot, logger, template, build, profile
-from cbuild.apk import sign, cli as apk_cli
+from cbuild.core import dependencies, depgraph, layers, server, metadata
+from cbuild.apk import sign, cli as apk_cli, compress as apk_compress
+from cbuild.apk import create as apk_create, verify as apk_verify
 
 logger.init(not opt_nocolor)
 
@@ -212,6 +242,23 @@ os.environ["PATH"] = os.environ["PATH"] + ":" + \
 # initialize profiles
 profile.init(global_cfg)
 
+# cached template metadata
+metadata.set_refresh(opt_nocache)
+
+# concurrent dependency builds
+dependencies.set_jobs(opt_pkgjobs)
+
+# throwaway build overlays
+chroot.set_overlay(opt_overlay)
+
+# package compression and rewriting
+apk_compress.setup(opt_compthreads, opt_compblock * 1024)
+apk_create.set_keep_identical(opt_keepsame)
+
+# cached dependency layers, only used with overlays
+if opt_overlay:
+    layers.set_limit(opt_layercache)
+
 # check target arch validity if provided
 if opt_arch:
     try:
@@ -262,7 +309,7 @@ def bootstrap(tgt):
         paths.prepare()
         chroot.initdb()
         chroot.repo_sync()
-        build.build(tgt, rp, {}, opt_signkey)
+        build.build(tgt, rp, opt_signkey)
         shutil.rmtree(paths.masterdir())
         chroot.install(chroot.host_cpu())
 
@@ -342,12 +389,24 @@ def do_clean(tgt):
         logger.get().out_red("cbuild: broken masterdir (destdir invalid)")
         raise Exception()
 
+def slot_masterdirs():
+    mdir = paths.masterdir()
+    return [
+        p for p in mdir.parent.glob(f"{mdir.name}-slot*")
+        if not p.name.endswith(".overlay")
+    ]
+
 def do_zap(tgt):
     if paths.masterdir().is_dir():
         shutil.rmtree(paths.masterdir())
     elif paths.masterdir().exists():
         logger.get().out_red("cbuild: broken masterdir")
         raise Exception()
+    # also zap any masterdirs used for concurrent builds
+    for mdir in slot_masterdirs():
+        chroot.remove_overlay(mdir)
+        shutil.rmtree(mdir)
+    chroot.remove_overlay()
 
 def do_remove_autodeps(tgt):
     chroot.remove_autodeps(None)
@@ -378,7 +437,200 @@ def do_pkg(tgt, pkgn = None):
     chroot.repo_sync()
     chroot.update(do_clean = False)
     chroot.remove_autodeps(False)
-    build.build(tgt, rp, {}, opt_signkey)
+    build.build(tgt, rp, opt_signkey)
+
+def collect_set(arg):
+    # a single template
+    if (paths.distdir() / arg / "template.py").is_file():
+        return [arg]
+    # a whole repository, subpackage symlinks are skipped
+    if (paths.distdir() / arg).is_dir():
+        ret = []
+        for tp in (paths.distdir() / arg).glob("*/template.py"):
+            if not tp.parent.is_symlink():
+                ret.append(f"{arg}/{tp.parent.name}")
+        ret.sort()
+        return ret
+    # a file with a list of templates and repositories
+    if pathlib.Path(arg).is_file():
+        ret = []
+        with open(arg) as setf:
+            for ln in setf:
+                ln = ln.strip()
+                if len(ln) == 0 or ln.startswith("#"):
+                    continue
+                ret += collect_set(ln)
+        return ret
+
+    logger.get().out_red(f"cbuild: invalid template set '{arg}'")
+    raise Exception()
+
+def do_build_set(tgt):
+    if len(cmdline.command) <= 1:
+        logger.get().out_red("cbuild: no templates given")
+        raise Exception()
+
+    arch = opt_arch if opt_arch else chroot.host_cpu()
+
+    roots = []
+    rdupes = {}
+    for arg in cmdline.command[1:]:
+        for pkgn in collect_set(arg):
+            key = dependencies.node_key(pkgn, arch)
+            if key in rdupes:
+                continue
+            rdupes[key] = True
+            def reader(pkgn = pkgn):
+                try:
+                    return template.read_pkg(
+                        pkgn, arch, opt_force, opt_skipexist, opt_check,
+                        opt_makejobs, opt_gen_dbg, opt_ccache, None
+                    )
+                except template.PackageError:
+                    # e.g. broken or not available for the architecture
+                    logger.get().warn(f"cbuild: skipping {pkgn}")
+                    raise template.SkipPackage()
+            roots.append((key, reader))
+
+    if opt_mdirtemp:
+        chroot.install(chroot.host_cpu())
+    # prepared once for the whole set
+    paths.prepare()
+    chroot.repo_sync()
+    chroot.update(do_clean = False)
+    chroot.remove_autodeps(False)
+
+    logger.get().out(f"cbuild: resolving {len(roots)} templates...")
+
+    graph, order = dependencies.resolve_graph(roots)
+
+    logger.get().out(f"cbuild: building {len(order)} templates...")
+
+    dependencies.build_graph(graph, order, "pkg", opt_signkey)
+
+def dep_graph():
+    return depgraph.build(opt_arch if opt_arch else chroot.host_cpu())
+
+def graph_set(graph, args):
+    ret = []
+    for arg in args:
+        for pkgn in collect_set(arg):
+            pn = graph.lookup(pkgn)
+            if not pn:
+                logger.get().warn(f"cbuild: {pkgn} is not in the graph")
+                continue
+            ret.append(pn)
+    return ret
+
+def do_rdeps(tgt):
+    if len(cmdline.command) <= 1:
+        logger.get().out_red("cbuild: no packages given")
+        raise Exception()
+
+    graph = dep_graph()
+
+    for pkgn in cmdline.command[1:]:
+        pn = graph.lookup(pkgn)
+        if not pn:
+            logger.get().out_red(f"cbuild: unknown package '{pkgn}'")
+            raise Exception()
+        for rd in graph.depending(pn):
+            print(rd)
+
+def do_build_order(tgt):
+    graph = dep_graph()
+
+    for pn in graph.build_order(graph_set(graph, cmdline.command[1:])):
+        print(pn)
+
+def do_critical_path(tgt):
+    graph = dep_graph()
+
+    for pn in graph.critical_path(graph_set(graph, cmdline.command[1:])):
+        print(pn)
+
+def collect_apks(args):
+    ret = []
+    for arg in args:
+        apath = pathlib.Path(arg)
+        if apath.is_dir():
+            ret += sorted(apath.rglob("*.apk"))
+        elif apath.is_file():
+            ret.append(apath)
+        else:
+            logger.get().out_red(f"cbuild: invalid package '{arg}'")
+            raise Exception()
+    return ret
+
+def do_verify(tgt):
+    if len(cmdline.command) > 1:
+        pkgs = collect_apks(cmdline.command[1:])
+    else:
+        # all of the repositories
+        pkgs = collect_apks([paths.repository()])
+
+    failed = 0
+
+    for rep in apk_verify.check_all(pkgs, opt_makejobs, opt_unsigned):
+        if rep.ok:
+            continue
+        failed += 1
+        logger.get().out_red(f"{rep.path}: verification failed")
+        for err in rep.errors:
+            logger.get().out_plain(f"  {err}")
+
+    logger.get().out(f"cbuild: verified {len(pkgs)} packages, {failed} failed")
+
+    if failed > 0:
+        raise Exception()
+
+def do_inspect(tgt):
+    if len(cmdline.command) <= 1:
+        logger.get().out_red("cbuild: no packages given")
+        raise Exception()
+
+    failed = False
+
+    for pkg in collect_apks(cmdline.command[1:]):
+        rep = apk_verify.inspect(pkg)
+        print(f"{pkg}:")
+        print(f"  signature: {rep.signature if rep.signature else 'none'}")
+        for fld, vals in rep.pkginfo.items():
+            for val in vals:
+                print(f"  {fld} = {val}")
+        print("  control:")
+        for cf in rep.control:
+            print(f"    {cf}")
+        print("  contents:")
+        for tinfo, csum in rep.files:
+            print(f"    {apk_verify.describe(tinfo)}")
+        for err in rep.errors:
+            logger.get().out_red(f"  {err}")
+            failed = True
+
+    if failed:
+        raise Exception()
+
+def do_serve(tgt):
+    if len(cmdline.command) > 1:
+        sockpath = pathlib.Path(cmdline.command[1]).resolve()
+    else:
+        sockpath = paths.hostdir() / "cbuild.sock"
+
+    def runner(step, pkgn, arch):
+        rp = template.read_pkg(
+            pkgn, arch, opt_force, opt_skipexist, opt_check, opt_makejobs,
+            opt_gen_dbg, opt_ccache, None
+        )
+        build.build(step, rp, opt_signkey)
+
+    # the concurrency limit is global, so every job builds serially
+    nslots = opt_pkgjobs
+    dependencies.set_jobs(1)
+
+    server.Server(
+        sockpath, runner, nslots, opt_arch if opt_arch else chroot.host_cpu()
+    ).serve()
 
 def do_bad(tgt):
     logger.get().out_red("cbuild: invalid target " + tgt)
@@ -397,6 +649,13 @@ try:
         "remove-autodeps": do_remove_autodeps,
         "prune-obsolete": do_prune_obsolete,
         "zap": do_zap,
+        "build-set": do_build_set,
+        "serve": do_serve,
+        "rdeps": do_rdeps,
+        "build-order": do_build_order,
+        "critical-path": do_critical_path,
+        "verify": do_verify,
+        "inspect": do_inspect,
         "fetch": do_pkg,
         "extract": do_pkg,
         "patch": do_pkg,
@@ -414,4 +673,8 @@ except:
     sys.exit(1)
 finally:
     if opt_mdirtemp:
+        chroot.remove_overlay()
         shutil.rmtree(paths.masterdir())
+        for mdir in slot_masterdirs():
+            chroot.remove_overlay(mdir)
+            shutil.rmtree(mdir)
@@ -1,12 +1,15 @@
 from cbuild.core import logger, paths, version
 
-from . import sign
+from . import util, indexgen, manifest
 
 import os
+import zlib
 import pathlib
+import tarfile
 import subprocess
 
-def _collect_repos(mrepo, intree, arch):
+# all repository paths with an index for the given architecture
+def repo_paths(mrepo, arch = None):
     from cbuild.core import chroot
 
     ret = []
@@ -24,14 +27,26 @@ def _collect_repos(mrepo, intree, arch):
 
     for r in chroot.get_confrepos():
         for cr in srepos:
-            rpath = paths.repository() / cr / r
-            if not (rpath / arch / "APKINDEX.tar.gz").is_file():
+            rpath = paths.repository() / cr / r / arch
+            if not (rpath / "APKINDEX.tar.gz").is_file():
                 continue
-            ret.append("--repository")
-            if intree:
-                ret.append(f"/binpkgs/{cr}/{r}")
-            else:
-                ret.append(str(rpath))
+            ret.append(rpath)
+
+    return ret
+
+def _collect_repos(mrepo, intree, arch):
+    ret = []
+
+    for rpath in repo_paths(mrepo, arch):
+        # the arch is implied
+        rpath = rpath.parent
+        ret.append("--repository")
+        if intree:
+            ret.append(
+                "/binpkgs/" + str(rpath.relative_to(paths.repository()))
+            )
+        else:
+            ret.append(str(rpath))
 
     return ret
 
@@ -72,51 +87,39 @@ def call_chroot(
         pretend_uid = 0, pretend_gid = 0, mount_binpkgs = True
     )
 
-def summarize_repo(repopath, olist, quiet = False):
+# must be called with the repository locked
+def summarize_repo(repopath, olist, quiet = False, ents = None):
     rtimes = {}
     obsolete = []
 
-    for f in repopath.glob("*.apk"):
-        fn = f.name
-        pf = fn[:-4]
-        rd = pf.rfind("-")
-        if rd > 0:
-            rd = pf.rfind("-", 0, rd)
-        if rd < 0:
-            if not quiet:
-                logger.get().warn(f"Malformed file name found, skipping: {fn}")
-            continue
-        pn = pf[0:rd]
-        mt = f.stat().st_mtime
+    if ents == None:
+        ents = manifest.load(repopath)
+
+    for fn in sorted(ents):
+        pn, pv, mt, sz, csum = ents[fn]
         if not pn in rtimes:
-            rtimes[pn] = (mt, f.name)
+            rtimes[pn] = (mt, fn, pv)
+            continue
+
+        omt, ofn, opv = rtimes[pn]
+        # this package is newer, so prefer it
+        if mt > omt:
+            fromf, fromv, tof, tov = ofn, opv, fn, pv
+        elif mt < omt:
+            fromf, fromv, tof, tov = fn, pv, ofn, opv
+        # same timestamp? should pretty much never happen
+        # take the newer version anyway
+        elif version.compare(pv, opv) > 0:
+            fromf, fromv, tof, tov = ofn, opv, fn, pv
         else:
-            omt, ofn = rtimes[pn]
-            # this package is newer, so prefer it
-            if mt > omt:
-                fromf = ofn
-                fromv = ofn[rd + 1:-4]
-                tof = f.name
-                tov = pf[rd + 1:]
-                rtimes[pn] = (mt, f.name)
-                obsolete.append(ofn)
-            elif mt < omt:
-                fromf = f.name
-                fromv = pf[rd + 1:]
-                tof = ofn
-                tov = ofn[rd + 1:-4]
-                obsolete.append(f.name)
-            else:
-                # same timestamp? should pretty much never happen
-                # take the newer version anyway
-                if version.compare(pf[rd + 1:], ofn[rd + 1:-4]) > 0:
-                    rtimes[pn] = (mt, f.name)
-                    obsolete.append(ofn)
-                else:
-                    obsolete.append(f.name)
-
-            if version.compare(tov, fromv) < 0 and not quiet:
-                logger.get().warn(f"Using lower version ({fromf} => {tof}): newer timestamp...")
+            fromf, fromv, tof, tov = fn, pv, ofn, opv
+
+        if tof == fn:
+            rtimes[pn] = (mt, fn, pv)
+        obsolete.append(fromf)
+
+        if version.compare(tov, fromv) < 0 and not quiet:
+            logger.get().warn(f"Using lower version ({fromf} => {tof}): newer timestamp...")
 
     for k, v in rtimes.items():
         olist.append(v[1])
@@ -133,60 +136,136 @@ def prune(repopath):
 
     logger.get().out(f"pruning old packages: {repopath}")
 
-    nlist = []
-    olist = summarize_repo(repopath, nlist, True)
+    with util.repo_lock(repopath):
+        # make sure we know about everything that is really there
+        if manifest.validate(repopath):
+            logger.get().warn("Repository manifest was out of date, fixed")
 
-    for pkg in olist:
-        print(f"pruning: {pkg}")
-        (repopath / pkg).unlink()
+        nlist = []
+        olist = summarize_repo(repopath, nlist, True)
 
-    logger.get().out("repo cleanup complete")
+        ents = manifest.read(repopath)
 
-def build_index(repopath, epoch, keypath):
-    repopath = pathlib.Path(repopath)
+        for pkg in olist:
+            print(f"pruning: {pkg}")
+            (repopath / pkg).unlink()
+            # build fingerprint, if any
+            (repopath / (pkg + ".fingerprint")).unlink(missing_ok = True)
+            del ents[pkg]
 
-    aargs = ["--quiet"]
+        manifest.write(repopath, ents)
 
-    if (repopath / "APKINDEX.tar.gz").is_file():
-        aargs += ["--index", "APKINDEX.tar.gz"]
+    logger.get().out("repo cleanup complete")
 
-    # if no key is given, just use the final index name
-    if not keypath:
-        aargs += ["--output", "APKINDEX.tar.gz"]
-    else:
-        aargs += ["--output", "APKINDEX.unsigned.tar.gz"]
+# packages may also be registered without indexing them right away, in
+# which case they are listed in the repository as pending and indexed all
+# at once later, e.g. at the end of a batch of dependency builds
+_defer = False
+
+def set_defer(defer):
+    global _defer
+    prev = _defer
+    _defer = defer
+    return prev
+
+def deferring():
+    return _defer
+
+# the packages waiting to be indexed are recorded in a single file at the
+# top of the repository tree, so that finding what needs to be flushed does
+# not involve looking at every repository
+def _pending_path():
+    return paths.repository() / ".cbuild_pending"
+
+def defer_index(repopath, pkgs, epoch):
+    with util.repo_lock(paths.repository()):
+        with open(_pending_path(), "a") as pf:
+            for pkg in pkgs:
+                pf.write(f"{int(epoch)}\t{repopath}\t{pkg}\n")
+
+# repository path -> list of (epoch, package file) waiting to be indexed,
+# the caller must hold the lock of the repository tree
+def _read_pending():
+    ret = {}
 
-    summarize_repo(repopath, aargs)
+    try:
+        with open(_pending_path()) as pf:
+            for ln in pf:
+                fl = ln.rstrip("\n").split("\t")
+                if len(fl) != 3:
+                    continue
+                ret.setdefault(pathlib.Path(fl[1]), []).append(
+                    (int(fl[0]), fl[2])
+                )
+    except FileNotFoundError:
+        pass
 
-    # create unsigned index
-    signr = call("index", aargs, None, cwd = repopath, env = {
-        "PATH": os.environ["PATH"],
-        "SOURCE_DATE_EPOCH": str(epoch)
-    }, allow_untrusted = not keypath)
-    if signr.returncode != 0:
-        logger.get().out_red("Indexing failed!")
-        return False
+    return ret
 
-    # we're done if no key is given
-    if not keypath:
+# indexes every repository with packages waiting; the ones that failed
+# stay pending
+def flush_pending(keypath):
+    if not _pending_path().is_file():
         return True
 
+    ret = True
+
+    with util.repo_lock(paths.repository()):
+        pend = _read_pending()
+        left = {}
+
+        for repopath in sorted(pend):
+            ents = pend[repopath]
+            epoch = max([ep for ep, pkg in ents])
+            logger.get().out(f"Registering new packages to {repopath}...")
+            if not build_index(repopath, epoch, keypath):
+                left[repopath] = ents
+                ret = False
+
+        if len(left) == 0:
+            _pending_path().unlink(missing_ok = True)
+            return ret
+
+        tpath = _pending_path().with_name(".cbuild_pending.tmp")
+        with open(tpath, "w") as pf:
+            for repopath in left:
+                for ep, pkg in left[repopath]:
+                    pf.write(f"{ep}\t{repopath}\t{pkg}\n")
+        os.replace(tpath, _pending_path())
+
+    return ret
+
+def build_index(repopath, epoch, keypath):
+    repopath = pathlib.Path(repopath)
+
+    # concurrent builds may be registering packages into the same repo
+    with util.repo_lock(repopath):
+        return _build_index(repopath, epoch, keypath)
+
+# the packages to index, mapped to their control checksums
+def _index_pkgs(repopath):
+    ents = manifest.sync(repopath)
+    pkgs = []
+    summarize_repo(repopath, pkgs, ents = ents)
+
+    return {fn: ents[fn][4] for fn in pkgs}
+
+def _build_index(repopath, epoch, keypath):
     try:
-        signhdr = sign.sign(
-            keypath, repopath / "APKINDEX.unsigned.tar.gz", epoch
-        )
-    except:
+        ret = indexgen.build(repopath, _index_pkgs(repopath), epoch, keypath)
+        # the manifest may be out of date, e.g. if a package was removed
+        # by hand, so check it against the repository and try once more
+        if not ret and manifest.validate(repopath):
+            logger.get().warn("Repository manifest was out of date, fixed")
+            ret = indexgen.build(
+                repopath, _index_pkgs(repopath), epoch, keypath
+            )
+    except (OSError, ValueError, zlib.error, tarfile.TarError) as e:
+        logger.get().out_red(f"Failed to write index: {e}")
+        ret = False
+
+    if not ret:
+        logger.get().out_red("Indexing failed!")
         return False
 
-    # write signed index
-    with open(repopath / "APKINDEX.tar.gz", "wb") as outf:
-        outf.write(signhdr)
-        with open(repopath / "APKINDEX.unsigned.tar.gz", "rb") as inf:
-            while True:
-                buf = inf.read(16 * 1024)
-                if not buf:
-                    break
-                outf.write(buf)
-        (repopath / "APKINDEX.unsigned.tar.gz").unlink()
-
     return True
@@ -0,0 +1,115 @@
+# Parallel gzip compression, in the same way as pigz does it.
+#
+# The input is split into fixed size blocks which are compressed on their
+# own (zlib releases the GIL, so threads are enough), each primed with the
+# last 32K of the preceding block and ended with a sync flush, so that the
+# results can simply be concatenated into a single standard gzip member.
+#
+# The output only depends on the block size and compression level, and is
+# always the same no matter how many threads are used.
+
+import io
+import zlib
+import struct
+import collections
+import concurrent.futures
+
+_threads = 1
+_blocksize = 128 * 1024
+
+# the size of the deflate window, and thereby of the dictionary
+_dictsize = 32 * 1024
+
+def setup(threads, blocksize):
+    global _threads, _blocksize
+
+    _threads = max(threads, 1)
+    _blocksize = max(blocksize, _dictsize)
+
+def threads():
+    return _threads
+
+def set_threads(threads):
+    global _threads
+
+    _threads = max(threads, 1)
+
+def _deflate(data, zdict, level, last):
+    if zdict:
+        co = zlib.compressobj(level, zlib.DEFLATED, -15, zdict = zdict)
+    else:
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    ret = co.compress(data)
+    if last:
+        return ret + co.flush(zlib.Z_FINISH)
+
+    return ret + co.flush(zlib.Z_SYNC_FLUSH)
+
+class GzipWriter(io.RawIOBase):
+    def __init__(self, fileobj, mtime = 0, level = 9, threads = None):
+        self.fileobj = fileobj
+        self.level = level
+        self.buf = bytearray()
+        self.zdict = None
+        self.crc = 0
+        self.size = 0
+        self.pending = collections.deque()
+
+        if not threads:
+            threads = _threads
+
+        self.threads = threads
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+
+        # no name, no extra flags; the OS is always unix
+        xfl = 2 if level == 9 else (4 if level == 1 else 0)
+        fileobj.write(struct.pack(
+            "<BBBBLBB", 0x1F, 0x8B, 8, 0, int(mtime) & 0xFFFFFFFF, xfl, 3
+        ))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def _drain(self, limit):
+        while len(self.pending) > limit:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def _submit(self, data, last):
+        self.pending.append(self.pool.submit(
+            _deflate, data, self.zdict, self.level, last
+        ))
+        self.zdict = data[-_dictsize:]
+        # do not queue up too much
+        self._drain(self.threads * 2)
+
+    def write(self, data):
+        data = memoryview(data)
+        dlen = len(data)
+
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += dlen
+
+        self.buf += data
+        while len(self.buf) >= _blocksize:
+            self._submit(bytes(self.buf[0:_blocksize]), False)
+            del self.buf[0:_blocksize]
+
+        return dlen
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self._submit(bytes(self.buf), True)
+            self._drain(0)
+            self.fileobj.write(struct.pack(
+                "<LL", self.crc, self.size & 0xFFFFFFFF
+            ))
+        finally:
+            self.pool.shutdown()
+            super().close()
@@ -1,15 +1,18 @@
 import os
 import io
 import gzip
+import zlib
+import base64
+import mmap
 import stat
 import tarfile
 import hashlib
+import errno
 import pathlib
-import tempfile
 import subprocess
 from datetime import datetime
 
-from . import util, sign
+from . import util, sign, compress, indexgen
 
 # emulate `du -ks` * 1024, which is what alpine uses for size
 def _du_k(fl):
@@ -24,18 +27,83 @@ def _du_k(fl):
             ret += int(st.st_blocks / 2)
     return ret * 1024
 
-def _hash_file(fp, md):
-    while True:
-        chunk = fp.read(16 * 1024)
-        if not chunk:
-            break
-        md.update(chunk)
-    return md.hexdigest()
+# files up to this size are read into memory as a whole, bigger ones are
+# mapped, either way they are only read once for both checksum and archive
+_small_file = 1024 * 1024
 
+# whether to leave existing packages alone when the new one would be the
+# same, so that they do not get rewritten (and their mtime bumped)
+_keep_identical = False
+
+def set_keep_identical(keep):
+    global _keep_identical
+    _keep_identical = keep
+
+def _is_identical(outfile, ctl, privkey):
+    try:
+        signame, csum, octl = indexgen.read_control(outfile)
+    except FileNotFoundError:
+        return False
+    except (OSError, zlib.error, tarfile.TarError, EOFError):
+        # broken, so definitely rewrite it
+        return False
+
+    if privkey:
+        if signame != sign.signature_name(privkey):
+            return False
+    elif signame:
+        return False
+
+    return octl == ctl
+
+# passes everything through to the file while computing its checksum
+class _HashWriter:
+    def __init__(self, fileobj, md):
+        self.fileobj = fileobj
+        self.md = md
+
+    def write(self, data):
+        self.md.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.md.hexdigest()
+
+# append the whole contents of one file to another within the kernel; on
+# filesystems with reflinks this may not even copy the data at all
+def _append_file(src, dst):
+    sfd = src.fileno()
+    dfd = dst.fileno()
+    left = os.fstat(sfd).st_size
+    off = 0
+    cfr = True
+
+    while left > 0:
+        if cfr:
+            try:
+                n = os.copy_file_range(sfd, dfd, left, off)
+            except OSError as e:
+                # e.g. an old kernel or a filesystem without support for it,
+                # fall back to sendfile for the rest
+                if not e.errno in (
+                    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP
+                ):
+                    raise
+                cfr = False
+                continue
+        else:
+            n = os.sendfile(dfd, sfd, off, left)
+        if n == 0:
+            raise OSError(errno.EIO, "unexpected end of file", src.name)
+        off += n
+        left -= n
+
+# returns the checksum of the new package, or None if an identical package
+# already existed and was kept
 def create(
-    pkgname, pkgver, arch, epoch, destdir, tmpdir, outfile, privkey, metadata
+    pkgname, pkgver, arch, epoch, destdir, outfile, privkey, metadata
 ):
-    tmpdir = pathlib.Path(tmpdir)
+    outfile = pathlib.Path(outfile)
     dt = datetime.utcfromtimestamp(epoch)
 
     # collect file list
@@ -141,76 +209,101 @@ def create(
         tinfo.mode = 0o755
         return tinfo
 
-    # data filter also has checksums
-    def data_filter(tinfo):
-        tinfo = ctrl_filter(tinfo)
+    # data also has checksums, which go in the header before the contents
+    def add_data(dtar, f, rf):
+        tinfo = ctrl_filter(dtar.gettarinfo(f, rf))
 
         if tinfo.issym():
-            cksum = hashlib.sha1(tinfo.linkname.encode()).hexdigest()
+            tinfo.pax_headers["APK-TOOLS.checksum.SHA1"] = hashlib.sha1(
+                tinfo.linkname.encode()
+            ).hexdigest()
         elif tinfo.isfile():
-            with open(destdir / tinfo.name, "rb") as rf:
-                cksum = _hash_file(rf, hashlib.sha1())
-        else:
-            cksum = None
-
-        if cksum:
-            tinfo.pax_headers["APK-TOOLS.checksum.SHA1"] = cksum
-
-        return tinfo
-
-    # data archive file
-    dtarf = tempfile.TemporaryFile(dir = tmpdir)
+            with open(f, "rb") as rf:
+                if tinfo.size <= _small_file:
+                    data = rf.read()
+                    contents = io.BytesIO(data)
+                else:
+                    data = mmap.mmap(
+                        rf.fileno(), 0, access = mmap.ACCESS_READ
+                    )
+                    contents = data
+            with contents:
+                tinfo.pax_headers["APK-TOOLS.checksum.SHA1"] = hashlib.sha1(
+                    data
+                ).hexdigest()
+                dtar.addfile(tinfo, contents)
+            return
 
-    # first data, since we gotta checksum it for the pkginfo
-    with tarfile.open(None, "w:gz", fileobj = dtarf) as dtar:
-        for f in flist:
-            rf = f.relative_to(destdir)
-            # skip the root
-            if len(rf.name) == 0:
-                continue
-            # add the file
-            dtar.add(f, str(rf), recursive = False, filter = data_filter)
-
-    # go back to the beginning after writing it
-    dtarf.seek(0)
-
-    # ended with sha256 of contents archive
-    add_field("datahash", _hash_file(dtarf, hashlib.sha256()))
-
-    # we'll need to read it one more time for the concat
-    dtarf.seek(0)
-
-    # now control, we need an uncompressed tar archive here for now
-    ctario = io.BytesIO()
-
-    with tarfile.open(None, "w", fileobj = ctario) as ctar:
-        cinfo = ctrl_filter(tarfile.TarInfo(".PKGINFO"))
-        cinfo.size = len(ctrl)
-        with io.BytesIO(ctrl) as cstream:
-            ctar.addfile(cinfo, cstream)
-        if "hooks" in metadata:
-            for hook in metadata["hooks"]:
-                ctar.add(hook, hook.name.removeprefix(pkgname), filter = hook_filter)
-
-    # concat together
-    with open(outfile, "wb") as ffile:
-        # compressed, stripped control data
-        compctl = gzip.compress(
-            util.strip_tar_endhdr(ctario.getvalue()), mtime = int(epoch)
-        )
-        # if given a key, sign control data and write signature first
-        if privkey:
-            ffile.write(sign.sign(privkey, compctl, epoch))
-        # then the control data
-        ffile.write(compctl)
-        # we don't need the control stream anymore
-        ctario.close()
-        # write the data and buffer it because it's potentially huge
-        while True:
-            buf = dtarf.read(16 * 1024)
-            if not buf:
-                break
-            ffile.write(buf)
-
-    # ditch the temporary data archive
-    dtarf.close()
+        dtar.addfile(tinfo)
+
+    # the data archive goes in a file next to the package rather than in
+    # temporary storage; the package is assembled from the header and the
+    # data afterwards, without passing the data through our buffers again
+    datapath = outfile.with_name(outfile.name + ".data")
+    newpath = outfile.with_name(outfile.name + ".new")
+
+    try:
+        with open(datapath, "w+b") as dtarf:
+            # the compressed data is checksummed as it is written
+            dhash = _HashWriter(dtarf, hashlib.sha256())
+
+            # first data, since we gotta checksum it for the pkginfo
+            with compress.GzipWriter(dhash, epoch) as gzf:
+                with tarfile.open(None, "w", fileobj = gzf) as dtar:
+                    for f in flist:
+                        rf = f.relative_to(destdir)
+                        # skip the root
+                        if len(rf.name) == 0:
+                            continue
+                        # add the file
+                        add_data(dtar, f, str(rf))
+
+            dtarf.flush()
+
+            # ended with sha256 of contents archive
+            add_field("datahash", dhash.hexdigest())
+
+            # now control, we need an uncompressed tar archive here for now
+            ctario = io.BytesIO()
+
+            with tarfile.open(None, "w", fileobj = ctario) as ctar:
+                cinfo = ctrl_filter(tarfile.TarInfo(".PKGINFO"))
+                cinfo.size = len(ctrl)
+                with io.BytesIO(ctrl) as cstream:
+                    ctar.addfile(cinfo, cstream)
+                if "hooks" in metadata:
+                    for hook in metadata["hooks"]:
+                        ctar.add(
+                            hook, hook.name.removeprefix(pkgname),
+                            filter = hook_filter
+                        )
+
+            ctl = util.strip_tar_endhdr(ctario.getvalue())
+            # we don't need the control stream anymore
+            ctario.close()
+
+            # the control data includes the checksum of the data, so if it
+            # is the same (and signed the same way), so is the package
+            if _keep_identical and _is_identical(outfile, ctl, privkey):
+                return None
+
+            # concat together
+            with open(newpath, "wb") as ffile:
+                # compressed, stripped control data
+                compctl = gzip.compress(ctl, mtime = int(epoch))
+                # if given a key, sign control data and write signature first
+                if privkey:
+                    ffile.write(sign.sign(privkey, compctl, epoch))
+                # then the control data
+                ffile.write(compctl)
+                # the appending happens at the current offset of the file
+                ffile.flush()
+                _append_file(dtarf, ffile)
+
+        os.replace(newpath, outfile)
+    finally:
+        datapath.unlink(missing_ok = True)
+        newpath.unlink(missing_ok = True)
+
+    # the identity of the package, as apk sees it
+    return "Q1" + base64.b64encode(hashlib.sha1(compctl).digest()).decode()
@@ -0,0 +1,183 @@
+# In-memory views of apk package databases, i.e. the repository indexes
+# (APKINDEX.tar.gz) and the database of installed packages in a root.
+#
+# Both use the same format (blocks of "X:value" lines separated by empty
+# lines), and they are parsed once and then cached until the file changes,
+# so that dependency checks are just dictionary lookups.
+
+from cbuild.core import paths, version
+
+import tarfile
+
+# the fields we care about; everything else (file lists in the installed
+# database and so on) is skipped during parsing
+_fields = {
+    "P": True, "V": True, "A": True, "D": True, "p": True, "o": True,
+}
+
+class Database:
+    def __init__(self):
+        # package name -> list of entries
+        self.names = {}
+        # provided name -> list of (entry, provided version or None)
+        self.provides = {}
+
+    def add(self, ent):
+        pn = ent.get("P", None)
+        pv = ent.get("V", None)
+        if not pn or not pv:
+            return
+
+        self.names.setdefault(pn, []).append(ent)
+
+        for prov in ent.get("p", "").split():
+            eq = prov.find("=")
+            if eq > 0:
+                self.provides.setdefault(prov[0:eq], []).append(
+                    (ent, prov[eq + 1:])
+                )
+            else:
+                self.provides.setdefault(prov, []).append((ent, None))
+
+    # all entries matching the given name, either by name or by provides
+    def find(self, pkgn):
+        ret = self.names.get(pkgn, None)
+        if ret:
+            return list(ret)
+
+        return [ent for ent, ver in self.provides.get(pkgn, [])]
+
+    # the same, along with the version each entry matches by, which is the
+    # provided version for provides (None if not versioned)
+    def find_versions(self, pkgn):
+        ret = self.names.get(pkgn, None)
+        if ret:
+            return [(ent, ent["V"]) for ent in ret]
+
+        return list(self.provides.get(pkgn, []))
+
+    def has(self, pkgn):
+        return pkgn in self.names or pkgn in self.provides
+
+def _parse(lines, db):
+    ent = {}
+
+    for ln in lines:
+        ln = ln.rstrip("\n")
+        if len(ln) == 0:
+            db.add(ent)
+            ent = {}
+            continue
+        if len(ln) < 2 or ln[1] != ":" or not ln[0] in _fields:
+            continue
+        ent[ln[0]] = ln[2:]
+
+    db.add(ent)
+
+    return db
+
+def _read_installed(path):
+    with open(path) as dbf:
+        return _parse(dbf, Database())
+
+def _read_index(path):
+    db = Database()
+
+    with tarfile.open(path, "r:gz") as itar:
+        for tinfo in itar:
+            if tinfo.name != "APKINDEX":
+                continue
+            with itar.extractfile(tinfo) as idxf:
+                _parse(idxf.read().decode().splitlines(), db)
+            break
+
+    return db
+
+# path -> (identity, database)
+_cache = {}
+
+def _get_cached(path, reader):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        _cache.pop(path, None)
+        return None
+
+    # invalidated whenever the file is replaced or modified
+    ident = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    cached = _cache.get(path, None)
+    if cached and cached[0] == ident:
+        return cached[1]
+
+    db = reader(path)
+    _cache[path] = (ident, db)
+
+    return db
+
+def installed(root = None):
+    from cbuild.core import chroot
+
+    dbpath = "usr/lib/apk/db/installed"
+
+    if not root:
+        root = paths.masterdir()
+        # once modified during a build, the database is in the overlay
+        for odir in chroot.overlay_dirs():
+            if (odir / dbpath).exists():
+                root = odir
+                break
+
+    return _get_cached(root / dbpath, _read_installed)
+
+def repository(indexpath):
+    return _get_cached(indexpath, _read_index)
+
+def repositories(mrepo, arch = None):
+    from . import cli
+
+    ret = []
+    for rpath in cli.repo_paths(mrepo, arch):
+        db = repository(rpath / "APKINDEX.tar.gz")
+        if db:
+            ret.append(db)
+
+    return ret
+
+# maps every shared library (so: provider) in the given databases to the
+# name of the package providing it, the first database taking precedence
+def shlib_providers(dbs):
+    ret = {}
+
+    for db in dbs:
+        for prov, ents in db.provides.items():
+            if prov.startswith("so:"):
+                ret.setdefault(prov[3:], ents[0][0]["P"])
+
+    return ret
+
+def is_installed(pkgn, root = None):
+    db = installed(root)
+    if not db:
+        return False
+
+    return db.has(pkgn)
+
+# the best version of the given package available in the repositories,
+# optionally matching the given pattern; returns None if not found
+def find_available(pkgn, pattern, mrepo, arch = None):
+    best = None
+
+    for db in repositories(mrepo, arch):
+        for ent, pv in db.find_versions(pkgn):
+            if not pv:
+                # an unversioned provider cannot satisfy a constraint
+                if pattern:
+                    continue
+                pv = ent["V"]
+            elif pattern and not version.match(f"{pkgn}-{pv}", pattern):
+                continue
+            if not best or version.compare(pv, best) > 0:
+                best = pv
+
+    return best
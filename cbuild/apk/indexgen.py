@@ -0,0 +1,232 @@
+# Generates repository indexes (APKINDEX.tar.gz) without apk.
+#
+# The previous index is read first and its entries are kept for packages
+# whose control checksum (as recorded in the repository manifest) is still
+# the same, so only new or changed packages are opened, and then only their
+# control segment is read.
+
+from cbuild.core import logger
+
+from . import sign
+
+import io
+import gzip
+import zlib
+import base64
+import hashlib
+import tarfile
+
+# .PKGINFO field -> index field, in the order apk writes them
+_fields = {
+    "pkgname": "P",
+    "pkgver": "V",
+    "arch": "A",
+    "size": "I",
+    "pkgdesc": "T",
+    "url": "U",
+    "license": "L",
+    "origin": "o",
+    "maintainer": "m",
+    "builddate": "t",
+    "commit": "c",
+    "provider_priority": "k",
+    "depend": "D",
+    "provides": "p",
+    "install_if": "i",
+    "replaces": "r",
+}
+
+# these are space separated lists in the index
+_lists = {
+    "D": True, "p": True, "i": True, "r": True,
+}
+
+_order = [
+    "C", "P", "V", "A", "S", "I", "T", "U", "L", "o", "m", "t", "c", "k",
+    "D", "p", "i", "r",
+]
+
+def _parse_index(data):
+    ret = {}
+    ent = {}
+
+    for ln in data.decode().split("\n"):
+        if len(ln) == 0:
+            if "P" in ent and "V" in ent:
+                ret[(ent["P"], ent["V"])] = ent
+            ent = {}
+            continue
+        if len(ln) < 2 or ln[1] != ":":
+            continue
+        ent[ln[0]] = ln[2:]
+
+    if "P" in ent and "V" in ent:
+        ret[(ent["P"], ent["V"])] = ent
+
+    return ret
+
+def _read_index(path):
+    try:
+        with tarfile.open(path, "r:gz") as itar:
+            for tinfo in itar:
+                if tinfo.name != "APKINDEX":
+                    continue
+                with itar.extractfile(tinfo) as idxf:
+                    return _parse_index(idxf.read())
+    except (FileNotFoundError, tarfile.TarError):
+        pass
+
+    return {}
+
+# splits off the gzip members one by one until it finds the control one,
+# which is the first one that does not hold a signature, and returns the
+# name of the signature (if any), the checksum of the control segment and
+# the control archive itself
+def read_control(path):
+    signame = None
+
+    with open(path, "rb") as f:
+        buf = b""
+        while True:
+            dobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            md = hashlib.sha1()
+            out = []
+            while not dobj.eof:
+                if len(buf) == 0:
+                    buf = f.read(64 * 1024)
+                    if len(buf) == 0:
+                        return None, None, None
+                out.append(dobj.decompress(buf))
+                # only what was actually consumed belongs to the member
+                md.update(buf[0:len(buf) - len(dobj.unused_data)])
+                buf = dobj.unused_data
+
+            ctl = b"".join(out)
+
+            with tarfile.open(None, "r", io.BytesIO(ctl)) as ctar:
+                tinfo = ctar.next()
+
+            if not tinfo or not tinfo.name.startswith(".SIGN."):
+                return signame, md.digest(), ctl
+
+            signame = tinfo.name
+
+def _read_pkginfo(path):
+    signame, csum, ctl = read_control(path)
+    if not ctl:
+        return None, None
+
+    with tarfile.open(None, "r", io.BytesIO(ctl)) as ctar:
+        for tinfo in ctar:
+            if tinfo.name == ".PKGINFO":
+                with ctar.extractfile(tinfo) as pf:
+                    return csum, pf.read().decode()
+
+    return None, None
+
+def _format_csum(csum):
+    return "Q1" + base64.b64encode(csum).decode()
+
+# the checksum apk identifies the package by
+def checksum(path):
+    csum, pkginfo = _read_pkginfo(path)
+    if not pkginfo:
+        return None
+
+    return _format_csum(csum)
+
+def _read_entry(path):
+    csum, pkginfo = _read_pkginfo(path)
+    if not pkginfo:
+        return None
+
+    ent = {"C": _format_csum(csum)}
+
+    for ln in pkginfo.split("\n"):
+        if ln.startswith("#"):
+            continue
+        eq = ln.find(" = ")
+        if eq < 0:
+            continue
+        fld = _fields.get(ln[0:eq], None)
+        if not fld:
+            continue
+        val = ln[eq + 3:]
+        if fld in _lists and fld in ent:
+            ent[fld] += " " + val
+        else:
+            ent[fld] = val
+
+    ent["S"] = str(path.stat().st_size)
+
+    if not "P" in ent or not "V" in ent:
+        return None
+
+    return ent
+
+# writes the index for the given package files in the repository, mapped to
+# their control checksums; returns False if any of them could not be read
+def build(repopath, pkgs, epoch, keypath):
+    ipath = repopath / "APKINDEX.tar.gz"
+
+    old = _read_index(ipath)
+
+    ents = []
+
+    for pkg, csum in pkgs.items():
+        ppath = repopath / pkg
+        ent = None
+        # the version may contain dashes, but not the revision
+        pf = pkg[:-4]
+        rd = pf.rfind("-", 0, pf.rfind("-"))
+        oent = old.get((pf[0:rd], pf[rd + 1:]), None)
+        if oent and oent.get("C", None) == csum:
+            ent = oent
+        else:
+            try:
+                ent = _read_entry(ppath)
+            except FileNotFoundError:
+                logger.get().out_red(f"Package '{pkg}' has gone away")
+                return False
+            except (OSError, zlib.error, tarfile.TarError, EOFError):
+                ent = None
+        if not ent:
+            logger.get().out_red(f"Failed to read package '{pkg}'")
+            return False
+        ents.append(ent)
+
+    ents.sort(key = lambda e: (e["P"], e["V"]))
+
+    idx = ""
+    for ent in ents:
+        for fld in _order:
+            if fld in ent:
+                idx += f"{fld}:{ent[fld]}\n"
+        idx += "\n"
+
+    idx = idx.encode()
+
+    tario = io.BytesIO()
+    with tarfile.open(None, "w", fileobj = tario) as itar:
+        tinfo = tarfile.TarInfo("APKINDEX")
+        tinfo.size = len(idx)
+        tinfo.mtime = int(epoch)
+        tinfo.mode = 0o644
+        tinfo.uname = "root"
+        tinfo.gname = "root"
+        with io.BytesIO(idx) as istream:
+            itar.addfile(tinfo, istream)
+
+    cidx = gzip.compress(tario.getvalue(), mtime = int(epoch))
+
+    tpath = repopath / "APKINDEX.tar.gz.new"
+
+    with open(tpath, "wb") as outf:
+        # the signature goes first, if given a key
+        if keypath:
+            outf.write(sign.sign(keypath, cidx, epoch))
+        outf.write(cidx)
+
+    tpath.rename(ipath)
+
+    return True
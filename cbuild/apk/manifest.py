@@ -0,0 +1,135 @@
+# A manifest of the packages in a repository, kept next to the index, so
+# that the repository does not have to be listed and every package in it
+# looked at whenever it is indexed or pruned.
+#
+# Every line has the file name, package name, version, modification time
+# (in nanoseconds), size and the checksum of the control segment (which is
+# what apk identifies packages by), separated by tabs. The manifest is only
+# changed with the repository locked, and always replaced as a whole.
+#
+# When missing, it is rebuilt by scanning the repository, and the scan is
+# also used to validate it when pruning. Before indexing, the names in it
+# are compared with the repository listing, so that packages added or
+# removed by other means are noticed.
+
+from cbuild.core import logger
+
+from . import util, indexgen
+
+import os
+import zlib
+import tarfile
+
+_name = ".cbuild_manifest"
+
+def read(repopath):
+    ret = {}
+
+    try:
+        with open(repopath / _name) as mf:
+            for ln in mf:
+                fl = ln.rstrip("\n").split("\t")
+                if len(fl) != 6:
+                    return None
+                ret[fl[0]] = (fl[1], fl[2], int(fl[3]), int(fl[4]), fl[5])
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.get().warn(f"Malformed manifest in {repopath}, rebuilding...")
+        return None
+
+    return ret
+
+def write(repopath, ents):
+    tpath = repopath / (_name + ".tmp")
+
+    with open(tpath, "w") as mf:
+        for fn in sorted(ents):
+            pn, pv, mt, sz, csum = ents[fn]
+            mf.write(f"{fn}\t{pn}\t{pv}\t{mt}\t{sz}\t{csum}\n")
+
+    os.replace(tpath, repopath / _name)
+
+# entries for the packages actually present in the repository, the ones
+# from the old manifest are reused if the file does not seem to differ
+def scan(repopath, old = None):
+    ret = {}
+
+    for f in repopath.glob("*.apk"):
+        fn = f.name
+        pf = fn[:-4]
+        # the version may contain dashes, but not the revision
+        rd = pf.rfind("-")
+        if rd > 0:
+            rd = pf.rfind("-", 0, rd)
+        if rd < 0:
+            logger.get().warn(f"Malformed file name found, skipping: {fn}")
+            continue
+
+        st = f.stat()
+
+        oent = old.get(fn, None) if old else None
+        if oent and oent[2] == st.st_mtime_ns and oent[3] == st.st_size:
+            ret[fn] = oent
+            continue
+
+        try:
+            csum = indexgen.checksum(f)
+        except (OSError, zlib.error, tarfile.TarError, EOFError):
+            csum = None
+
+        if not csum:
+            logger.get().warn(f"Unreadable package found, skipping: {fn}")
+            continue
+
+        ret[fn] = (pf[0:rd], pf[rd + 1:], st.st_mtime_ns, st.st_size, csum)
+
+    return ret
+
+# record a newly created package
+def add(repopath, fname, pkgname, pkgver, csum):
+    st = (repopath / fname).stat()
+
+    with util.repo_lock(repopath):
+        ents = load(repopath)
+        ents[fname] = (pkgname, pkgver, st.st_mtime_ns, st.st_size, csum)
+        write(repopath, ents)
+
+# the following must be called with the repository locked
+
+def load(repopath):
+    ents = read(repopath)
+
+    if ents == None:
+        ents = scan(repopath)
+        write(repopath, ents)
+
+    return ents
+
+# the same, but rescanned if the files in the repository are not the ones
+# in the manifest
+def sync(repopath):
+    ents = load(repopath)
+
+    names = {}
+    for fn in os.listdir(repopath):
+        if fn.endswith(".apk"):
+            names[fn] = True
+
+    if names.keys() != ents.keys():
+        logger.get().warn(f"Repository {repopath} changed, rescanning...")
+        ents = scan(repopath, ents)
+        write(repopath, ents)
+
+    return ents
+
+# returns True if the manifest was out of date
+def validate(repopath):
+    old = read(repopath)
+    ents = scan(repopath, old)
+
+    if ents == old:
+        return False
+
+    write(repopath, ents)
+    return True
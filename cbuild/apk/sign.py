@@ -7,10 +7,27 @@ import time
 import getpass
 import pathlib
 import tarfile
+import tempfile
 import subprocess
 
 from . import util
 
+# signing in process is a lot cheaper than running openssl every time, so
+# it is done that way whenever the cryptography module is available
+try:
+    from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+except ImportError:
+    serialization = None
+
+# key path -> (identity, parsed private key), the key being None if it
+# cannot be used in process; the identity is checked on every use so that
+# a long running server notices replaced keys
+_keys = {}
+# the same for public keys
+_pubkeys = {}
+
 def _get_keypath(keypath):
     keypath = pathlib.Path(keypath)
 
@@ -24,9 +41,42 @@ def _get_keypath(keypath):
         # otherwise a path relative to distdir
         return paths.distdir() / keypath
 
-# returns the compressed signature data given
-# either an input file path or raw input bytes
-def sign(keypath, data, epoch):
+def _key_ident(keypath):
+    st = pathlib.Path(keypath).stat()
+    return (st.st_mtime_ns, st.st_size)
+
+def _load_key(keypath):
+    if not serialization:
+        return None
+
+    ident = _key_ident(keypath)
+    cached = _keys.get(keypath, None)
+    if cached and cached[0] == ident:
+        return cached[1]
+
+    try:
+        with open(keypath, "rb") as kf:
+            key = serialization.load_pem_private_key(kf.read(), None)
+        if not isinstance(key, rsa.RSAPrivateKey):
+            key = None
+    except (ValueError, TypeError, UnsupportedAlgorithm):
+        # e.g. encrypted or unsupported keys, leave those to openssl
+        key = None
+
+    _keys[keypath] = (ident, key)
+    return key
+
+# the raw signature of the data, which is the same as what openssl dgst
+# produces as pkcs#1 v1.5 signatures are deterministic
+def _sign_raw(keypath, data):
+    key = _load_key(keypath)
+
+    if key:
+        if not isinstance(data, bytes):
+            with open(data, "rb") as df:
+                data = df.read()
+        return key.sign(data, padding.PKCS1v15(), hashes.SHA1())
+
     if isinstance(data, bytes):
         inparg = []
         inpval = data
@@ -34,15 +84,6 @@ def sign(keypath, data, epoch):
         inparg = [data]
         inpval = None
 
-    keypath = _get_keypath(keypath)
-
-    if not keypath.is_file():
-        logger.get().out_red(f"Non-existent private key '{keypath}'")
-        raise Exception()
-
-    keyname = keypath.name + ".pub"
-    signame = ".SIGN.RSA." + keyname
-
     sout = subprocess.run([
         "openssl", "dgst", "-sha1", "-sign", keypath, "-out", "-"
     ] + inparg, input = inpval, capture_output = True)
@@ -52,8 +93,66 @@ def sign(keypath, data, epoch):
         logger.get().out_plain(sout.stderr.strip().decode())
         raise Exception()
 
+    return sout.stdout
+
+def _load_pubkey(keypath):
+    if not serialization:
+        return None
+
+    ident = _key_ident(keypath)
+    cached = _pubkeys.get(keypath, None)
+    if cached and cached[0] == ident:
+        return cached[1]
+
+    try:
+        with open(keypath, "rb") as kf:
+            key = serialization.load_pem_public_key(kf.read())
+        if not isinstance(key, rsa.RSAPublicKey):
+            key = None
+    except (ValueError, TypeError, UnsupportedAlgorithm):
+        key = None
+
+    _pubkeys[keypath] = (ident, key)
+    return key
+
+# checks a raw signature of the data against the given public key
+def verify(keypath, data, sigdata):
+    key = _load_pubkey(keypath)
+
+    if key:
+        try:
+            key.verify(sigdata, data, padding.PKCS1v15(), hashes.SHA1())
+        except InvalidSignature:
+            return False
+        return True
+
+    with tempfile.NamedTemporaryFile() as sigf:
+        sigf.write(sigdata)
+        sigf.flush()
+        vout = subprocess.run([
+            "openssl", "dgst", "-sha1", "-verify", keypath,
+            "-signature", sigf.name
+        ], input = data, capture_output = True)
+
+    return vout.returncode == 0
+
+# the name of the signature file within packages and indexes
+def signature_name(keypath):
+    return ".SIGN.RSA." + _get_keypath(keypath).name + ".pub"
+
+# returns the compressed signature data given
+# either an input file path or raw input bytes
+def sign(keypath, data, epoch):
+    keypath = _get_keypath(keypath)
+
+    if not keypath.is_file():
+        logger.get().out_red(f"Non-existent private key '{keypath}'")
+        raise Exception()
+
+    signame = signature_name(keypath)
+
     sigio = io.BytesIO()
-    rawdata = sout.stdout
+    rawdata = _sign_raw(keypath, data)
 
     with tarfile.open(None, "w", fileobj = sigio) as sigtar:
         tinfo = tarfile.TarInfo(signame)
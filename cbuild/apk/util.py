@@ -1,6 +1,8 @@
 from cbuild.core import version
 
 import re
+import fcntl
+import contextlib
 
 def strip_tar_endhdr(data):
     tlen = len(data)
@@ -58,3 +60,14 @@ def split_pkg_name(s):
 
 def pkg_match(pkgv, pattern):
     return version.match(pkgv, pattern)
+
+# serializes modifications of a repository between concurrent builds
+@contextlib.contextmanager
+def repo_lock(repopath):
+    repopath.mkdir(parents = True, exist_ok = True)
+    with open(repopath / ".cbuild_lock", "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
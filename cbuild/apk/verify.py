@@ -0,0 +1,241 @@
+# Inspection and verification of apk packages without apk.
+#
+# A package is a concatenation of gzip members: the signature (optional),
+# the control archive and the data archive, in that order. The members are
+# split while streaming the file, so the data is never held in memory as a
+# whole, and everything is checked on the way:
+#
+# - the signature of the compressed control member, against etc/keys
+# - the checksum of the compressed data member (datahash in .PKGINFO)
+# - the checksum of every file and symlink in the data
+#
+# Many packages can be verified in parallel, in separate processes.
+
+from cbuild.core import paths
+
+from . import sign
+
+import io
+import stat
+import zlib
+import hashlib
+import tarfile
+import multiprocessing
+import concurrent.futures
+
+# a single gzip member of the underlying file, decompressed on the fly; the
+# compressed data is checksummed and may also be kept
+class _Member(io.RawIOBase):
+    def __init__(self, fileobj, buf, md = None, keep = False):
+        self.fileobj = fileobj
+        self.buf = buf
+        self.md = md
+        self.raw = [] if keep else None
+        self.dobj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.out = b""
+        self.off = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while self.off == len(self.out) and not self.dobj.eof:
+            if len(self.buf) == 0:
+                self.buf = self.fileobj.read(64 * 1024)
+                if len(self.buf) == 0:
+                    raise EOFError("unexpected end of package")
+            self.out = self.dobj.decompress(self.buf, 256 * 1024)
+            self.off = 0
+            if self.dobj.eof:
+                rest = self.dobj.unused_data
+            else:
+                rest = self.dobj.unconsumed_tail
+            used = self.buf[0:len(self.buf) - len(rest)]
+            if self.md:
+                self.md.update(used)
+            if self.raw != None:
+                self.raw.append(used)
+            self.buf = rest
+
+    def readinto(self, b):
+        self._fill()
+        n = min(len(b), len(self.out) - self.off)
+        b[0:n] = self.out[self.off:self.off + n]
+        self.off += n
+        return n
+
+    # reads the rest of the member, returns what is left of the file
+    def finish(self):
+        while not self.dobj.eof:
+            self.off = len(self.out)
+            self._fill()
+        return self.buf
+
+    def rawdata(self):
+        return b"".join(self.raw)
+
+class Report:
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        # field -> list of values
+        self.pkginfo = {}
+        self.control = []
+        # (tarinfo, checksum) for everything in the data
+        self.files = []
+        self.errors = []
+
+    def field(self, name):
+        return self.pkginfo.get(name, [None])[0]
+
+    @property
+    def ok(self):
+        return len(self.errors) == 0
+
+# a line of the contents listing, similar to ls -l
+def describe(tinfo):
+    if tinfo.isdir():
+        tc = "d"
+    elif tinfo.issym():
+        tc = "l"
+    elif tinfo.islnk():
+        tc = "h"
+    else:
+        tc = "-"
+
+    ret = f"{tc}{stat.filemode(tinfo.mode)[1:]} {tinfo.size:>10} {tinfo.name}"
+    if tinfo.issym() or tinfo.islnk():
+        ret += f" -> {tinfo.linkname}"
+
+    return ret
+
+def _parse_pkginfo(rep, data):
+    for ln in data.decode().split("\n"):
+        if ln.startswith("#"):
+            continue
+        eq = ln.find(" = ")
+        if eq < 0:
+            continue
+        rep.pkginfo.setdefault(ln[0:eq], []).append(ln[eq + 3:])
+
+def _check_signature(rep, ctl, sigdata, keydir):
+    pubn = rep.signature.removeprefix(".SIGN.RSA.")
+    pubk = keydir / pubn
+
+    if not pubk.is_file():
+        rep.errors.append(f"signed with an unknown key '{pubn}'")
+    elif not sign.verify(pubk, ctl, sigdata):
+        rep.errors.append(f"bad signature (key '{pubn}')")
+
+def _check_data(rep, dtar):
+    for tinfo in dtar:
+        csum = tinfo.pax_headers.get("APK-TOOLS.checksum.SHA1", None)
+        rep.files.append((tinfo, csum))
+
+        if tinfo.issym():
+            real = hashlib.sha1(tinfo.linkname.encode()).hexdigest()
+        elif tinfo.isfile():
+            md = hashlib.sha1()
+            with dtar.extractfile(tinfo) as df:
+                while True:
+                    buf = df.read(64 * 1024)
+                    if not buf:
+                        break
+                    md.update(buf)
+            real = md.hexdigest()
+        else:
+            continue
+
+        if not csum:
+            rep.errors.append(f"no checksum for '{tinfo.name}'")
+        elif csum != real:
+            rep.errors.append(f"checksum mismatch for '{tinfo.name}'")
+
+def _read(path, keydir, allow_unsigned):
+    rep = Report(path)
+
+    with open(path, "rb") as f:
+        # signature or control
+        mem = _Member(f, b"", keep = True)
+        sigdata = None
+
+        with tarfile.open(None, "r|", mem) as ctar:
+            for tinfo in ctar:
+                if tinfo.name.startswith(".SIGN."):
+                    rep.signature = tinfo.name
+                    sigdata = ctar.extractfile(tinfo).read()
+                    break
+                rep.control.append(tinfo.name)
+                if tinfo.name == ".PKGINFO":
+                    _parse_pkginfo(rep, ctar.extractfile(tinfo).read())
+
+        buf = mem.finish()
+
+        if rep.signature:
+            mem = _Member(f, buf, keep = True)
+            with tarfile.open(None, "r|", mem) as ctar:
+                for tinfo in ctar:
+                    rep.control.append(tinfo.name)
+                    if tinfo.name == ".PKGINFO":
+                        _parse_pkginfo(rep, ctar.extractfile(tinfo).read())
+            buf = mem.finish()
+            _check_signature(rep, mem.rawdata(), sigdata, keydir)
+        elif not allow_unsigned:
+            rep.errors.append("not signed")
+
+        if not ".PKGINFO" in rep.control:
+            rep.errors.append("no .PKGINFO in control data")
+
+        # the data, checksummed as a whole
+        dmd = hashlib.sha256()
+        mem = _Member(f, buf, md = dmd)
+
+        with tarfile.open(None, "r|", mem) as dtar:
+            _check_data(rep, dtar)
+
+        buf = mem.finish()
+
+        if len(buf) > 0 or len(f.read(1)) > 0:
+            rep.errors.append("trailing garbage after data")
+
+    dhash = rep.field("datahash")
+    if not dhash:
+        rep.errors.append("no datahash in .PKGINFO")
+    elif dhash != dmd.hexdigest():
+        rep.errors.append("data checksum mismatch")
+
+    return rep
+
+def inspect(path, allow_unsigned = True):
+    return check(path, paths.distdir() / "etc" / "keys", allow_unsigned)
+
+def check(path, keydir, allow_unsigned = False):
+    try:
+        return _read(path, keydir, allow_unsigned)
+    except (OSError, EOFError, zlib.error, tarfile.TarError) as e:
+        rep = Report(path)
+        rep.errors.append(f"malformed package: {e}")
+        return rep
+
+def _check_brief(path, keydir, allow_unsigned):
+    rep = check(path, keydir, allow_unsigned)
+    # the listing is not needed and may be huge
+    rep.files = []
+    return rep
+
+# verifies the given packages in parallel, yielding reports in order
+def check_all(pkgs, jobs, allow_unsigned = False):
+    keydir = paths.distdir() / "etc" / "keys"
+
+    if jobs <= 1 or len(pkgs) <= 1:
+        for pkg in pkgs:
+            yield _check_brief(pkg, keydir, allow_unsigned)
+        return
+
+    ctx = multiprocessing.get_context("fork")
+
+    with concurrent.futures.ProcessPoolExecutor(jobs, ctx) as ex:
+        yield from ex.map(
+            _check_brief, pkgs, [keydir] * len(pkgs),
+            [allow_unsigned] * len(pkgs), chunksize = 4
+        )
@@ -1,23 +1,77 @@
 from cbuild.step import fetch, extract, patch, configure
 from cbuild.step import build as buildm, check, install, prepkg, pkg as pkgsm
 from cbuild.core import chroot, logger, dependencies
-from cbuild.core import template, pkg as pkgm, paths
-from cbuild.apk import cli as apk
+from cbuild.core import template, pkg as pkgm, paths, fingerprint
+from cbuild.apk import cli as apk, compress
 
-import os
+import multiprocessing.connection as mpconn
+import multiprocessing
+import traceback
 import pathlib
+import sys
+import os
+
+# all packages of the template were built with the same fingerprint
+def _is_fresh(pkg):
+    repo = paths.repository() / pkg.repository / pkg.build_profile.arch
+
+    for sp in [pkg] + pkg.subpkg_list:
+        if not fingerprint.is_fresh(repo / f"{sp.pkgver}.apk", pkg.fingerprint):
+            return False
+
+    return True
+
+def _pkg_one(sp, cthreads):
+    compress.set_threads(cthreads)
+    try:
+        pkgsm.invoke(sp)
+    except template.PackageError:
+        # already reported
+        sys.exit(1)
+    except:
+        sp.log_red("failed to generate package")
+        traceback.print_exc(file = logger.get().estream)
+        sys.exit(1)
+
+# generate the binary packages of the template, the subpackages do not
+# depend on each other so they are done in parallel, up to the job count,
+# with the compression threads split between them
+def _pkg_all(pkg):
+    pkgs = pkg.subpkg_list + [pkg]
+    jobs = max(pkg.conf_jobs, 1)
+
+    if jobs == 1 or len(pkgs) == 1:
+        for sp in pkgs:
+            pkgsm.invoke(sp)
+        return
+
+    cthreads = max(compress.threads() // min(jobs, len(pkgs)), 1)
 
-def build(step, pkg, depmap, signkey, chost = False):
-    if chost:
-        depn = "host-" + pkg.pkgname
-    else:
-        depn = pkg.pkgname
+    ctx = multiprocessing.get_context("fork")
 
-    if pkg.pkgname in depmap or depn in depmap:
-        pkg.error(f"build-time dependency cycle encountered for {pkg.pkgname} (dependency of {pkg.origin.pkgname})")
+    running = {}
+    failed = []
 
-    depmap[depn] = True
+    while (len(pkgs) > 0 and len(failed) == 0) or len(running) > 0:
+        while len(pkgs) > 0 and len(running) < jobs and len(failed) == 0:
+            sp = pkgs.pop(0)
+            proc = ctx.Process(target = _pkg_one, args = (sp, cthreads))
+            # pending output would get duplicated in the child otherwise
+            sys.stdout.flush()
+            sys.stderr.flush()
+            proc.start()
+            running[proc.sentinel] = (proc, sp)
 
+        for sent in mpconn.wait(list(running.keys())):
+            proc, sp = running.pop(sent)
+            proc.join()
+            if proc.exitcode != 0:
+                failed.append(sp.pkgname)
+
+    if len(failed) > 0:
+        pkg.error(f"failed to generate packages: {', '.join(failed)}")
+
+def build(step, pkg, signkey):
     pkg.install_done = False
     pkg.current_phase = "setup"
 
@@ -31,7 +85,17 @@ def build(step, pkg, depmap, signkey, chost = False):
     dependencies.remove_autocrossdeps(pkg)
 
     # check and install dependencies
-    autodep = dependencies.install(pkg, pkg.origin.pkgname, "pkg", depmap, signkey)
+    autodep = dependencies.install(pkg, pkg.origin.pkgname, "pkg", signkey)
+
+    # the dependencies are final now, so is the fingerprint
+    pkg.fingerprint = fingerprint.compute(pkg)
+
+    if step == "pkg" and not pkg.force_mode and _is_fresh(pkg):
+        pkg.log("fresh binary packages already exist, skipping...")
+        if not chroot.end_overlay():
+            chroot.remove_autodeps(pkg.bootstrapping)
+        dependencies.remove_autocrossdeps(pkg)
+        return
 
     oldcwd = pkg.cwd
     oldchd = pkg.chroot_cwd
@@ -108,10 +172,7 @@ def build(step, pkg, depmap, signkey, chost = False):
     pkg.signing_key = signkey
 
     # generate binary packages
-    for sp in pkg.subpkg_list:
-        pkgsm.invoke(sp)
-
-    pkgsm.invoke(pkg)
+    _pkg_all(pkg)
 
     # register binary packages
 
@@ -128,6 +189,10 @@ def build(step, pkg, depmap, signkey, chost = False):
             pkgs.append(pkgn.strip())
 
     for repo in genrepos:
+        # indexed later together with the other packages of the batch
+        if apk.deferring():
+            apk.defer_index(repo, genrepos[repo], pkg.source_date_epoch)
+            continue
         logger.get().out(f"Registering new packages to {repo}...")
         if not apk.build_index(repo, pkg.source_date_epoch, signkey):
             logger.get().out_red(f"Indexing apk repositories failed.")
@@ -136,10 +201,9 @@ def build(step, pkg, depmap, signkey, chost = False):
     pkg.signing_key = None
 
     # cleanup
-    chroot.remove_autodeps(pkg.bootstrapping)
+    if not chroot.end_overlay():
+        chroot.remove_autodeps(pkg.bootstrapping)
     dependencies.remove_autocrossdeps(pkg)
     pkgm.remove_pkg_wrksrc(pkg)
     pkgm.remove_pkg(pkg)
     pkgm.remove_pkg_statedir(pkg)
-
-    del depmap[depn]
@@ -9,11 +9,19 @@ import pathlib
 from tempfile import mkstemp
 
 from cbuild.core import logger, paths
-from cbuild.apk import cli as apki
+from cbuild.apk import cli as apki, index as apkidx
 
 _chroot_checked = False
 _chroot_ready = False
 
+# whether builds use a throwaway overlay on top of the masterdir
+_use_overlay = False
+# upper directory of the currently active overlay
+_overlay = None
+# extra read-only layers between the masterdir and the upper directory,
+# bottom first, along with whatever keeps them alive (e.g. a lock file)
+_overlay_layers = []
+
 def host_cpu():
     return _host
 
@@ -244,9 +252,7 @@ def remove_autodeps(bootstrapping):
 
     failed = False
 
-    if apki.call("info", [
-        "--installed", "autodeps-host"
-    ], None, capture_output = True, allow_untrusted = True).returncode == 0:
+    if apkidx.is_installed("autodeps-host"):
         if bootstrapping:
             del_ret = apki.call("del", [
                 "--no-scripts", "autodeps-host"
@@ -261,9 +267,7 @@ def remove_autodeps(bootstrapping):
             log.out_plain(del_ret.stderr.decode())
             failed = True
 
-    if apki.call("info", [
-        "--installed", "autodeps-target"
-    ], None, capture_output = True, allow_untrusted = True).returncode == 0:
+    if apkidx.is_installed("autodeps-target"):
         if bootstrapping:
             del_ret = apki.call("del", [
                 "--no-scripts", "autodeps-target"
@@ -282,6 +286,88 @@ def remove_autodeps(bootstrapping):
         log.out_red("cbuild: failed to remove autodeps")
         raise Exception()
 
+def set_overlay(use):
+    global _use_overlay
+    _use_overlay = use
+
+def overlay_path(mdir = None):
+    if not mdir:
+        mdir = paths.masterdir()
+    return mdir.with_name(mdir.name + ".overlay")
+
+def overlay_upper():
+    return _overlay
+
+# all directories making up the root during a build, topmost first
+def overlay_dirs():
+    if not _overlay:
+        return []
+    return [_overlay] + [lp for lp, lh in reversed(_overlay_layers)]
+
+# removes a tree which may contain directories without write or search
+# permission, such as overlayfs work directories or layers of packages
+def remove_tree(path):
+    for dirp, dirs, files in os.walk(path):
+        for d in dirs:
+            dpath = os.path.join(dirp, d)
+            if not os.path.islink(dpath):
+                os.chmod(dpath, 0o755)
+
+    shutil.rmtree(path)
+
+def remove_overlay(mdir = None):
+    opath = overlay_path(mdir)
+    if not opath.exists():
+        return
+
+    remove_tree(opath)
+
+# turn the current upper directory into a read-only layer at the given
+# path (the caller moves it there) and start over with an empty one
+def push_overlay_layer(lpath, handle = None):
+    _overlay_layers.append((lpath, handle))
+    _overlay.mkdir(exist_ok = True)
+
+# start a fresh overlay for a build, all further changes made to the root
+# from within the sandbox go in there, leaving the masterdir pristine
+#
+# only native builds are supported, since bootstrap and cross builds modify
+# the masterdir from outside the sandbox
+def begin_overlay(pkg):
+    global _overlay
+
+    if not _use_overlay or pkg.bootstrapping or pkg.build_profile.cross:
+        return False
+
+    # leftovers of a failed build
+    end_overlay()
+    remove_overlay()
+
+    opath = overlay_path()
+    (opath / "upper").mkdir(parents = True)
+    (opath / "work").mkdir()
+
+    _overlay = opath / "upper"
+
+    return True
+
+# discard the overlay along with everything installed in it
+def end_overlay():
+    global _overlay
+
+    if not _overlay:
+        return False
+
+    for lp, lh in _overlay_layers:
+        if lh:
+            lh.close()
+
+    _overlay = None
+    _overlay_layers.clear()
+    remove_overlay()
+
+    return True
+
 def update(do_clean = True):
     if not chroot_check():
         return
@@ -363,9 +449,16 @@ def enter(cmd, args = [], capture_out = False, check = False,
             cwd = os.path.abspath(wrkdir) if wrkdir else None
         )
 
-    bcmd = [
-        "bwrap",
-        root_bind, paths.masterdir(), "/",
+    if _overlay:
+        # later sources are stacked on top
+        bcmd = ["bwrap", "--overlay-src", paths.masterdir()]
+        for lp, lh in _overlay_layers:
+            bcmd += ["--overlay-src", lp]
+        bcmd += ["--overlay", _overlay, _overlay.with_name("work"), "/"]
+    else:
+        bcmd = ["bwrap", root_bind, paths.masterdir(), "/"]
+
+    bcmd += [
         build_bind, paths.masterdir() / "builddir", "/builddir",
         dest_bind, paths.masterdir() / "destdir", "/destdir",
         "--ro-bind", paths.hostdir() / "sources", "/sources",
@@ -380,6 +473,10 @@ def enter(cmd, args = [], capture_out = False, check = False,
     if mount_ccache:
         bcmd += ["--bind", paths.hostdir() / "ccache", "/ccache"]
 
+    # overlays are always writable, so make them read-only afterwards
+    if _overlay and ro_root:
+        bcmd += ["--remount-ro", "/"]
+
     if pretend_uid != None:
         bcmd += ["--uid", str(pretend_uid)]
     if pretend_gid != None:
@@ -1,13 +1,19 @@
-from cbuild.core import logger, template, paths, chroot
+from cbuild.core import logger, template, paths, chroot, metadata, layers
 from cbuild.step import build as do_build
 from cbuild.apk import create as apkc, util as autil, cli as apki
+from cbuild.apk import index as apkidx
 from os import makedirs
+import multiprocessing.connection as mpconn
+import multiprocessing
+import contextlib
+import traceback
 import tempfile
 import pathlib
 import shutil
 import time
+import sys
 
-# avoid re-parsing same templates every time; the version will
+# avoid looking up same templates every time; the version will
 # never be conditional and that is the only thing we care about
 _tcache = {}
 
@@ -17,15 +23,14 @@ def _srcpkg_ver(pkgn, pkgb):
     if pkgn in _tcache:
         return _tcache[pkgn]
 
-    rv = template.read_pkg(
-        pkgn, pkgb.build_profile.arch,
-        False, False, False, 1, False, False, None,
-        resolve = pkgb, ignore_missing = True
+    # the persistent cache only executes the template if it has changed
+    rv = metadata.get(
+        pkgn, pkgb.build_profile.arch, resolve = pkgb, ignore_missing = True
     )
     if not rv:
         return None
 
-    cv = f"{rv.version}-r{rv.revision}"
+    cv = f"{rv['version']}-r{rv['revision']}"
     _tcache[pkgn] = cv
 
     return cv
@@ -106,41 +111,18 @@ def _install_from_repo(pkg, pkglist, virtn, signkey, cross = False):
 def _is_installed(pkgn, pkg = None):
     if pkg and pkg.build_profile.cross:
         sysp = paths.masterdir() / pkg.build_profile.sysroot.relative_to("/")
-        aarch = pkg.build_profile.arch
     else:
         sysp = paths.masterdir()
-        aarch = None
 
-    return apki.call(
-        "info", ["--installed", pkgn], None, root = sysp,
-        capture_output = True, arch = aarch, allow_untrusted = True
-    ).returncode == 0
+    return apkidx.is_installed(pkgn, sysp)
 
 def _is_available(pkgn, pattern, pkg, host = False):
     if not host and pkg.build_profile.cross:
-        sysp = paths.masterdir() / pkg.build_profile.sysroot.relative_to("/")
         aarch = pkg.build_profile.arch
     else:
-        sysp = paths.masterdir()
         aarch = None
 
-    aout = apki.call(
-        "search", ["-e", pkgn], pkg, root = sysp, capture_output = True,
-        arch = aarch, allow_untrusted = True
-    )
-
-    if aout.returncode != 0:
-        return None
-
-    pn = aout.stdout.strip().decode()
-
-    if len(pn) == 0:
-        return None
-
-    if not pattern or autil.pkg_match(pn, pattern):
-        return pn[len(pkgn) + 1:]
-
-    return None
+    return apkidx.find_available(pkgn, pattern, pkg, aarch)
 
 def install_toolchain(pkg, signkey):
     if not pkg.build_profile.cross:
@@ -158,7 +140,7 @@ def install_toolchain(pkg, signkey):
             f"main/base-cross-{archn}", chroot.host_cpu(),
             False, True, pkg.run_check, pkg.conf_jobs, pkg.build_dbg,
             pkg.use_ccache, None
-        ), {}, signkey, chost = True)
+        ), signkey)
     except template.SkipPackage:
         pass
 
@@ -183,7 +165,7 @@ def setup_dummy(pkg, rootp):
     try:
         apkc.create(
             pkgn, pkgv, pkg.build_profile.arch,
-            epoch, tmpd, tmpd, repod / f"{pkgn}-{pkgv}.apk", None,
+            epoch, tmpd, repod / f"{pkgn}-{pkgv}.apk", None,
             {
                 "pkgdesc": "Target sysroot virtual provider",
                 "provides": [
@@ -251,10 +233,7 @@ def remove_autocrossdeps(pkg):
     sysp = paths.masterdir() / pkg.build_profile.sysroot.relative_to("/")
     archn = pkg.build_profile.arch
 
-    if apki.call(
-        "info", ["--installed", "autodeps-target"], None, root = sysp,
-        capture_output = True, arch = archn, allow_untrusted = True
-    ).returncode != 0:
+    if not apkidx.is_installed("autodeps-target", sysp):
         return
 
     pkg.log(f"removing autocrossdeps for {archn}...")
@@ -268,18 +247,7 @@ def remove_autocrossdeps(pkg):
         log.out_plain(del_ret.stderr.decode())
         pkg.error("failed to remove autocrossdeps for {archn}")
 
-def install(pkg, origpkg, step, depmap, signkey):
-    style = ""
-    if pkg.build_style:
-        style = f" [{pkg.build_style}]"
-
-    tarch = pkg.build_profile.arch
-
-    if pkg.pkgname != origpkg:
-        pkg.log(f"building{style} (dependency of {origpkg}) for {tarch}...")
-    else:
-        pkg.log(f"building{style} for {tarch}...")
-
+def _check_depends(pkg, origpkg, quiet = False):
     host_binpkg_deps = []
     binpkg_deps = []
     host_missing_deps = []
@@ -288,30 +256,31 @@ def install(pkg, origpkg, step, depmap, signkey):
 
     log = logger.get()
 
-    ihdeps, itdeps, irdeps = _setup_depends(pkg)
+    def out(msg):
+        if not quiet:
+            log.out_plain(msg)
 
-    if len(ihdeps) == 0 and len(itdeps) == 0 and len(irdeps) == 0:
-        return
+    ihdeps, itdeps, irdeps = _setup_depends(pkg)
 
     for sver, pkgn in ihdeps:
         # check if already installed
         if _is_installed(pkgn):
-            log.out_plain(f"   [host] {pkgn}: installed")
+            out(f"   [host] {pkgn}: installed")
             continue
         # check if available in repository
         aver = _is_available(
             pkgn, (pkgn + "=" + sver) if sver else None, pkg, host = True
         )
         if aver:
-            log.out_plain(f"   [host] {pkgn}: found ({aver})")
+            out(f"   [host] {pkgn}: found ({aver})")
             host_binpkg_deps.append(pkgn)
             continue
         # dep finder did not previously resolve a template
         if not sver:
-            log.out_plain(f"   [host] {pkgn}: unresolved build dependency")
+            out(f"   [host] {pkgn}: unresolved build dependency")
             pkg.error(f"host dependency '{pkgn}' does not exist")
         # not found
-        log.out_plain(f"   [host] {pkgn}: not found")
+        out(f"   [host] {pkgn}: not found")
         # check for loops
         if not pkg.cross_build and (pkgn == origpkg or pkgn == pkg.pkgname):
             pkg.error(f"[host] build loop detected: {pkgn} <-> {origpkg}")
@@ -321,22 +290,22 @@ def install(pkg, origpkg, step, depmap, signkey):
     for sver, pkgn in itdeps:
         # check if already installed
         if _is_installed(pkgn, pkg):
-            log.out_plain(f"   [target] {pkgn}: installed")
+            out(f"   [target] {pkgn}: installed")
             continue
         # check if available in repository
         aver = _is_available(
             pkgn, (pkgn + "=" + sver) if sver else None, pkg
         )
         if aver:
-            log.out_plain(f"   [target] {pkgn}: found ({aver})")
+            out(f"   [target] {pkgn}: found ({aver})")
             binpkg_deps.append(pkgn)
             continue
         # dep finder did not previously resolve a template
         if not sver:
-            log.out_plain(f"   [target] {pkgn}: unresolved build dependency")
+            out(f"   [target] {pkgn}: unresolved build dependency")
             pkg.error(f"target dependency '{pkgn}' does not exist")
         # not found
-        log.out_plain(f"   [target] {pkgn}: not found")
+        out(f"   [target] {pkgn}: not found")
         # check for loops
         if pkgn == origpkg or pkgn == pkg.pkgname:
             pkg.error(f"[target] build loop detected: {pkgn} <-> {origpkg}")
@@ -352,7 +321,7 @@ def install(pkg, origpkg, step, depmap, signkey):
         if pkgn != origin:
             # subpackage depending on parent
             if pkgn == pkg.pkgname:
-                log.out_plain(f"   [runtime] {dep}: subpackage (ignored)")
+                out(f"   [runtime] {dep}: subpackage (ignored)")
                 continue
             # parent or another subpackage depending on subpackage
             is_subpkg = False
@@ -361,7 +330,7 @@ def install(pkg, origpkg, step, depmap, signkey):
                     is_subpkg = True
                     break
             if is_subpkg:
-                log.out_plain(f"   [runtime] {dep}: subpackage (ignored)")
+                out(f"   [runtime] {dep}: subpackage (ignored)")
                 continue
         else:
             # if package and its origin are the same, it depends on itself
@@ -372,53 +341,291 @@ def install(pkg, origpkg, step, depmap, signkey):
         # check the repository
         aver = _is_available(pkgn, dep, pkg)
         if aver:
-            log.out_plain(f"   [runtime] {dep}: found ({aver})")
+            out(f"   [runtime] {dep}: found ({aver})")
             continue
         # not found
-        log.out_plain(f"   [runtime] {dep}: not found")
+        out(f"   [runtime] {dep}: not found")
         # consider missing
         missing_rdeps.append(pkgn)
 
-    from cbuild.core import build
+    return (
+        host_binpkg_deps, binpkg_deps,
+        host_missing_deps, missing_deps, missing_rdeps
+    )
 
-    chost = chroot.host_cpu()
+# number of dependency builds that may run at the same time
+_jobs = 1
+
+def set_jobs(jobs):
+    global _jobs
+    _jobs = max(jobs, 1)
+
+# when set, every node is built within the context returned by it for the
+# node key, so that whatever else is building at the same time (e.g. other
+# jobs of the build server) does not build the same package concurrently
+_claim = None
+
+def set_claim(claim):
+    global _claim
+    _claim = claim
+
+# the key identifying a template in the build graph; subpackage symlinks
+# resolve to their parent so that each template is only built once
+def node_key(pname, arch):
+    tpath = (paths.distdir() / pname).resolve()
+    return (f"{tpath.parent.name}/{tpath.name}", arch)
+
+def _read_dep(pkgn, arch, parent):
+    return template.read_pkg(
+        pkgn, arch, parent.force_mode, True, parent.run_check,
+        parent.conf_jobs, parent.build_dbg, parent.use_ccache, parent,
+        resolve = parent
+    )
 
-    for pn in host_missing_deps:
-        try:
-            build.build(step, template.read_pkg(
-                pn, chost if not pkg.bootstrapping else None,
-                pkg.force_mode, True, pkg.run_check, pkg.conf_jobs,
-                pkg.build_dbg, pkg.use_ccache, pkg, resolve = pkg
-            ), depmap, signkey, chost = not not pkg.cross_build)
-        except template.SkipPackage:
-            pass
-        host_binpkg_deps.append(pn)
+# a list of missing templates in the form of (key, reader)
+def _missing_list(pkg, host_missing, missing, missing_r):
+    chost = chroot.host_cpu() if not pkg.bootstrapping else None
+    tarch = pkg.build_profile.arch if not pkg.bootstrapping else None
+
+    def dep_node(pkgn, arch):
+        return (
+            node_key(template.resolve_pkgname(pkgn, pkg), arch),
+            lambda: _read_dep(pkgn, arch, pkg)
+        )
+
+    return [dep_node(pn, chost) for pn in host_missing] + \
+        [dep_node(pn, tarch) for pn in missing + missing_r]
+
+# resolve the entire graph of missing dependencies before building anything,
+# the roots are given as (key, reader) and the result is a mapping of nodes
+# to their readers and dependencies, plus an ordering in which every node
+# comes after all of its dependencies; nodes in the initial chain are
+# considered in progress and depending on them is a cycle
+def resolve_graph(roots, chain = []):
+    graph = {}
+    order = []
+    chain = list(chain)
+    rootmap = dict(roots)
+
+    def visit(key, reader):
+        if key in chain:
+            cycle = " -> ".join(map(lambda k: k[0], chain[chain.index(key):]))
+            logger.get().out_red(
+                f"cbuild: build-time dependency cycle encountered: " +
+                f"{cycle} -> {key[0]}"
+            )
+            raise template.PackageError()
+        if key in graph:
+            return key
+
+        # an explicitly requested package takes priority
+        reader = rootmap.get(key, reader)
 
-    for pn in missing_deps:
         try:
-            build.build(step, template.read_pkg(
-                pn, tarch if not pkg.bootstrapping else None,
-                pkg.force_mode, True, pkg.run_check, pkg.conf_jobs,
-                pkg.build_dbg, pkg.use_ccache, pkg, resolve = pkg
-            ), depmap, signkey)
+            dpkg = reader()
         except template.SkipPackage:
-            pass
-        binpkg_deps.append(pn)
+            return None
+
+        chain.append(key)
+
+        hb, tb, hmiss, tmiss, rmiss = _check_depends(
+            dpkg, dpkg.origin.pkgname, True
+        )
+
+        deps = set()
+        for dkey, dreader in _missing_list(dpkg, hmiss, tmiss, rmiss):
+            dkey = visit(dkey, dreader)
+            if dkey:
+                deps.add(dkey)
+
+        chain.pop()
+
+        graph[key] = (reader, deps)
+        order.append(key)
+
+        return key
+
+    for key, reader in roots:
+        visit(key, reader)
 
-    for rd in missing_rdeps:
+    return graph, order
+
+def _build_node(key, node, step, signkey):
+    from cbuild.core import build
+
+    reader, deps = node
+
+    # if someone else was building it, it is usually fresh by now
+    with _claim(key) if _claim else contextlib.nullcontext():
         try:
-            build.build(step, template.read_pkg(
-                rd, tarch if not pkg.bootstrapping else None,
-                pkg.force_mode, True, pkg.run_check, pkg.conf_jobs,
-                pkg.build_dbg, pkg.use_ccache, pkg, resolve = pkg
-            ), depmap, signkey)
+            build.build(step, reader(), signkey)
         except template.SkipPackage:
             pass
-        host_binpkg_deps.append(rd)
+
+# switch to another masterdir (in a forked process), setting it up first
+def use_masterdir(mdir, bootstrapping):
+    hcpu = chroot.host_cpu()
+
+    paths.set_masterdir(mdir)
+
+    if not chroot.chroot_check(True) and not bootstrapping:
+        chroot.install(hcpu)
+        chroot.chroot_check(True)
+
+    chroot.set_host(hcpu)
+    paths.prepare()
+
+    if bootstrapping:
+        chroot.initdb()
+
+    chroot.repo_sync()
+    chroot.remove_autodeps(bootstrapping)
+
+def _slot_build(mdir, key, node, step, signkey):
+    try:
+        # every slot has its own masterdir to build in
+        use_masterdir(mdir, not key[1])
+        _build_node(key, node, step, signkey)
+    except:
+        logger.get().out_red(f"cbuild: failed to build {key[0]}")
+        traceback.print_exc(file = logger.get().estream)
+        sys.exit(1)
+
+# index whatever the builds of the batch so far have left pending
+def flush_pending(signkey):
+    if not apki.flush_pending(signkey):
+        logger.get().out_red(f"Indexing apk repositories failed.")
+        raise Exception()
+
+def build_graph(graph, order, step, signkey):
+    # the packages are only indexed when needed, and at the end
+    outer = not apki.set_defer(True)
+
+    try:
+        _build_graph(graph, order, step, signkey)
+    finally:
+        if outer:
+            apki.set_defer(False)
+            flush_pending(signkey)
+
+def _build_graph(graph, order, step, signkey):
+    if _jobs == 1:
+        for key in order:
+            _build_node(key, graph[key], step, signkey)
+        return
+
+    ctx = multiprocessing.get_context("fork")
+
+    # remaining dependencies of each node
+    waiting = {}
+    for key in order:
+        waiting[key] = set(graph[key][1])
+
+    ready = [key for key in order if len(waiting[key]) == 0]
+    slots = list(range(_jobs))
+    running = {}
+    failed = []
+    built = 0
+
+    # whatever depends on a failed node is never ready, the rest goes on
+    while len(ready) > 0 or len(running) > 0:
+        # fill up all the free slots
+        while len(ready) > 0 and len(slots) > 0:
+            key = ready.pop(0)
+            slot = slots.pop(0)
+            proc = ctx.Process(target = _slot_build, args = (
+                paths.slot_masterdir(slot), key, graph[key], step, signkey
+            ))
+            proc.start()
+            running[proc.sentinel] = (proc, key, slot)
+
+        for sent in mpconn.wait(list(running.keys())):
+            proc, key, slot = running.pop(sent)
+            proc.join()
+            slots.append(slot)
+
+            if proc.exitcode != 0:
+                failed.append(key[0])
+                continue
+
+            built += 1
+
+            # unlock whatever was waiting for this
+            for okey in order:
+                if key in waiting[okey]:
+                    waiting[okey].remove(key)
+                    if len(waiting[okey]) == 0:
+                        ready.append(okey)
+
+    if len(failed) > 0:
+        logger.get().out_red(
+            f"cbuild: failed to build dependencies: {', '.join(failed)}"
+        )
+        skipped = len(order) - built - len(failed)
+        if skipped > 0:
+            logger.get().out_red(
+                f"cbuild: {skipped} dependent package(s) were not built"
+            )
+        raise Exception()
+
+def install(pkg, origpkg, step, signkey):
+    style = ""
+    if pkg.build_style:
+        style = f" [{pkg.build_style}]"
+
+    tarch = pkg.build_profile.arch
+
+    if pkg.pkgname != origpkg:
+        pkg.log(f"building{style} (dependency of {origpkg}) for {tarch}...")
+    else:
+        pkg.log(f"building{style} for {tarch}...")
+
+    ihdeps, itdeps, irdeps = _setup_depends(pkg)
+
+    if len(ihdeps) == 0 and len(itdeps) == 0 and len(irdeps) == 0:
+        return
+
+    # earlier builds of the batch may have left what we need unindexed,
+    # which may be anything (provides, transitive dependencies and so on)
+    flush_pending(signkey)
+
+    host_binpkg_deps, binpkg_deps, host_missing_deps, missing_deps, \
+        missing_rdeps = _check_depends(pkg, origpkg)
+
+    missing = _missing_list(
+        pkg, host_missing_deps, missing_deps, missing_rdeps
+    )
+
+    if len(missing) > 0:
+        pkg.log("resolving missing dependencies...")
+        # the package itself is considered in progress, for cycle detection
+        graph, order = resolve_graph(missing, [node_key(
+            f"{pkg.repository}/{pkg.pkgname}",
+            tarch if not pkg.bootstrapping else None
+        )])
+        build_graph(graph, order, step, signkey)
+        # they are about to be installed
+        flush_pending(signkey)
+
+    host_binpkg_deps += host_missing_deps
+    binpkg_deps += missing_deps
+    host_binpkg_deps += missing_rdeps
 
     # reinit after parsings
     chroot.set_target(tarch)
 
+    lkey = None
+
+    # the build dependencies go in a throwaway overlay when enabled, and
+    # the overlay may be set up from a cached layer
+    if chroot.begin_overlay(pkg) and layers.enabled() and (
+        len(host_binpkg_deps) > 0 or len(binpkg_deps) > 0
+    ):
+        lkey, lset = layers.key_for(pkg, host_binpkg_deps, binpkg_deps)
+        if lkey and layers.use(lkey):
+            pkg.log(f"using cached dependency layer {lkey[0:12]}")
+            return
+
     if len(host_binpkg_deps) > 0:
         pkg.log(f"installing host dependencies: {', '.join(host_binpkg_deps)}")
         _install_from_repo(pkg, host_binpkg_deps, "autodeps-host", signkey)
@@ -426,3 +633,6 @@ def install(pkg, origpkg, step, depmap, signkey):
     if len(binpkg_deps) > 0:
         pkg.log(f"installing target dependencies: {', '.join(binpkg_deps)}")
         _install_from_repo(pkg, binpkg_deps, "autodeps-target", signkey, True)
+
+    if lkey:
+        layers.store(lkey, lset)
@@ -0,0 +1,219 @@
+# A dependency graph of the whole tree, built from cached template metadata.
+#
+# Every node is a template ("repo/name"). Build dependencies are resolved the
+# same way as when building (through the source repositories of the template,
+# including .parent links), while runtime dependencies can also be satisfied
+# by subpackages, provides and shlib provides of other templates.
+
+from cbuild.core import logger, paths, template, metadata
+from cbuild.apk import util as autil
+
+# the canonical name of the template in the given directory; subpackage
+# symlinks resolve to the template they point to
+def _canon(pname):
+    tpath = (paths.distdir() / pname).resolve()
+    return f"{tpath.parent.name}/{tpath.name}"
+
+# repositories are linked together by .parent, the root of the chain
+# (main) is the only one without a link
+def _repositories():
+    ret = set()
+    for rd in paths.distdir().iterdir():
+        if (rd / ".parent").is_symlink():
+            ret.update(template.source_repositories(rd.name))
+    return sorted(ret)
+
+def _dep_name(dep):
+    # strip negation and version constraints
+    if dep.startswith("!"):
+        return None
+    pn, pv, pop = autil.split_pkg_name(dep)
+    if pn:
+        return pn
+    return dep
+
+class Graph:
+    def __init__(self, arch):
+        self.arch = arch
+        # template -> metadata
+        self.templates = {}
+        # provided name -> template
+        self.providers = {}
+        # template -> set of templates it depends on (build and runtime)
+        self.build_deps = {}
+        self.run_deps = {}
+        # template -> set of templates depending on it
+        self.rdeps = {}
+        # templates that could not be used for the architecture
+        self.unavailable = []
+
+    def _add_provider(self, name, tmpl):
+        if not name in self.providers:
+            self.providers[name] = tmpl
+
+    def _load(self):
+        for repo in _repositories():
+            for tp in (paths.distdir() / repo).glob("*/template.py"):
+                if tp.parent.is_symlink():
+                    continue
+                pname = f"{repo}/{tp.parent.name}"
+                try:
+                    md = metadata.get(pname, self.arch)
+                except template.PackageError:
+                    self.unavailable.append(pname)
+                    continue
+                self.templates[pname] = md
+
+        # package names take priority over anything else
+        for pname, md in self.templates.items():
+            self._add_provider(md["pkgname"], pname)
+            for sp in md["subpackages"]:
+                self._add_provider(sp["pkgname"], pname)
+
+        for pname, md in self.templates.items():
+            for spd in [md] + md["subpackages"]:
+                for prov in spd["provides"]:
+                    self._add_provider(_dep_name(prov), pname)
+                for soname, sfx in spd["shlib_provides"]:
+                    self._add_provider("so:" + soname, pname)
+
+    def _resolve_build(self, pname, dep):
+        for r in template.source_repositories(pname.split("/")[0]):
+            if (paths.distdir() / r / dep / "template.py").is_file():
+                return _canon(f"{r}/{dep}")
+        return None
+
+    def _resolve_run(self, pname, dep):
+        dep = _dep_name(dep)
+        if not dep:
+            return None
+        ret = self._resolve_build(pname, dep)
+        if ret:
+            return ret
+        return self.providers.get(dep, None)
+
+    def _link(self):
+        for pname, md in self.templates.items():
+            bdeps = set()
+            for dep in md["hostmakedepends"] + md["makedepends"]:
+                dn = self._resolve_build(pname, dep)
+                if dn and dn != pname and dn in self.templates:
+                    bdeps.add(dn)
+
+            rdeps = set()
+            for spd in [md] + md["subpackages"]:
+                for dep in spd["depends"]:
+                    dn = self._resolve_run(pname, dep)
+                    if dn and dn != pname and dn in self.templates:
+                        rdeps.add(dn)
+
+            self.build_deps[pname] = bdeps
+            self.run_deps[pname] = rdeps
+
+            for dn in bdeps | rdeps:
+                self.rdeps.setdefault(dn, set()).add(pname)
+
+    # find the template for a template path, package name or provider
+    def lookup(self, name):
+        if name in self.templates:
+            return name
+        if (paths.distdir() / name / "template.py").is_file():
+            cn = _canon(name)
+            if cn in self.templates:
+                return cn
+        return self.providers.get(name, None)
+
+    def deps_of(self, pname):
+        return self.build_deps[pname] | self.run_deps[pname]
+
+    # everything depending on the template, optionally transitively
+    def depending(self, pname, transitive = True):
+        ret = set()
+        queue = [pname]
+
+        while len(queue) > 0:
+            for rd in self.rdeps.get(queue.pop(), ()):
+                if rd in ret:
+                    continue
+                ret.add(rd)
+                if transitive:
+                    queue.append(rd)
+
+        ret.discard(pname)
+
+        return sorted(ret)
+
+    # the given templates plus everything they need to build
+    def closure(self, pnames):
+        ret = set()
+        queue = list(pnames)
+
+        while len(queue) > 0:
+            pn = queue.pop()
+            if pn in ret:
+                continue
+            ret.add(pn)
+            queue += self.deps_of(pn)
+
+        return ret
+
+    # an order in which all dependencies of a template come before it
+    def build_order(self, pnames):
+        nodes = self.closure(pnames)
+        waiting = {}
+        for pn in nodes:
+            waiting[pn] = set(self.deps_of(pn)) & nodes
+
+        ret = []
+        ready = sorted([pn for pn in nodes if len(waiting[pn]) == 0])
+
+        while len(ready) > 0:
+            pn = ready.pop(0)
+            ret.append(pn)
+            for rd in sorted(self.rdeps.get(pn, ())):
+                if not rd in waiting or not pn in waiting[rd]:
+                    continue
+                waiting[rd].remove(pn)
+                if len(waiting[rd]) == 0:
+                    ready.append(rd)
+
+        if len(ret) != len(nodes):
+            cyc = sorted([pn for pn in nodes if len(waiting[pn]) > 0])
+            logger.get().out_red(
+                f"cbuild: dependency cycle among: {', '.join(cyc)}"
+            )
+            raise Exception()
+
+        return ret
+
+    # the longest chain of templates that have to be built one after another
+    def critical_path(self, pnames):
+        longest = {}
+        prev = {}
+
+        for pn in self.build_order(pnames):
+            longest[pn] = 1
+            prev[pn] = None
+            for dn in self.deps_of(pn):
+                if longest[dn] + 1 > longest[pn]:
+                    longest[pn] = longest[dn] + 1
+                    prev[pn] = dn
+
+        if len(longest) == 0:
+            return []
+
+        pn = max(sorted(longest), key = lambda v: longest[v])
+        ret = []
+        while pn:
+            ret.append(pn)
+            pn = prev[pn]
+
+        ret.reverse()
+
+        return ret
+
+def build(arch):
+    g = Graph(arch)
+    g._load()
+    g._link()
+    return g
@@ -0,0 +1,230 @@
+# A minimal ELF reader, providing the information that scanelf used to:
+# the machine, class, object type, interpreter, needed libraries, soname
+# and whether there are text relocations.
+#
+# Files are mapped rather than read, so only the headers and the dynamic
+# section are ever touched, and whole trees are scanned in a thread pool.
+# The results may be cached by file identity, so that unchanged files are
+# not looked at again.
+
+import os
+import mmap
+import stat
+import struct
+import concurrent.futures
+
+ET_NONE = 0
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+ET_CORE = 4
+
+EM_NONE = 0
+
+_PT_LOAD = 1
+_PT_DYNAMIC = 2
+_PT_INTERP = 3
+
+_DT_NULL = 0
+_DT_NEEDED = 1
+_DT_STRTAB = 5
+_DT_SONAME = 14
+_DT_TEXTREL = 22
+_DT_FLAGS = 30
+
+_DF_TEXTREL = 0x4
+
+# (header, program header, dynamic entry) by class
+_formats = {
+    1: ("HHIIIIIHHHHHH", "IIIIIIII", "iI"),
+    2: ("HHIQQQIHHHHHH", "IIQQQQQQ", "qQ"),
+}
+
+class ElfFile:
+    __slots__ = (
+        "bits", "machine", "etype", "interp", "needed", "soname",
+        "textrel", "static",
+    )
+
+    def __init__(self, bits, machine, etype):
+        self.bits = bits
+        self.machine = machine
+        self.etype = etype
+        self.interp = None
+        self.needed = []
+        self.soname = None
+        self.textrel = False
+        # no dynamic section at all
+        self.static = True
+
+# to and from plain data, for caching
+def dump(ef):
+    return {k: getattr(ef, k) for k in ElfFile.__slots__}
+
+def load(data):
+    ret = ElfFile(data["bits"], data["machine"], data["etype"])
+    for k in ElfFile.__slots__:
+        setattr(ret, k, data[k])
+    return ret
+
+def _cstr(mm, off):
+    end = mm.find(b"\0", off)
+    if end < 0:
+        raise ValueError("unterminated string")
+    return mm[off:end].decode(errors = "replace")
+
+def _parse(mm):
+    if len(mm) < 52 or mm[0:4] != b"\x7fELF":
+        return None
+
+    ecls = mm[4]
+    edata = mm[5]
+
+    if not ecls in _formats or (edata != 1 and edata != 2):
+        return None
+
+    end = "<" if edata == 1 else ">"
+    ehdr, phdr, dyn = [struct.Struct(end + f) for f in _formats[ecls]]
+
+    if len(mm) < 16 + ehdr.size:
+        return None
+
+    etype, machine, ever, entry, phoff, shoff, flags, ehsize, \
+        phentsize, phnum, shentsize, shnum, shstrndx = ehdr.unpack_from(mm, 16)
+
+    ret = ElfFile(32 if ecls == 1 else 64, machine, etype)
+
+    loads = []
+    dynamic = None
+
+    for i in range(phnum):
+        off = phoff + i * phentsize
+        if off + phdr.size > len(mm):
+            raise ValueError("truncated program headers")
+        if ecls == 1:
+            ptype, poff, pvaddr, ppaddr, pfsz, pmsz, pflags, palign = \
+                phdr.unpack_from(mm, off)
+        else:
+            ptype, pflags, poff, pvaddr, ppaddr, pfsz, pmsz, palign = \
+                phdr.unpack_from(mm, off)
+        if ptype == _PT_LOAD:
+            loads.append((pvaddr, poff, pfsz))
+        elif ptype == _PT_DYNAMIC:
+            dynamic = (poff, pfsz)
+        elif ptype == _PT_INTERP:
+            ret.interp = _cstr(mm, poff)
+
+    if not dynamic:
+        return ret
+
+    ret.static = False
+
+    needed = []
+    soname = None
+    strtab = None
+
+    off, dend = dynamic
+    dend = min(off + dend, len(mm))
+
+    while off + dyn.size <= dend:
+        tag, val = dyn.unpack_from(mm, off)
+        off += dyn.size
+        if tag == _DT_NULL:
+            break
+        elif tag == _DT_NEEDED:
+            needed.append(val)
+        elif tag == _DT_SONAME:
+            soname = val
+        elif tag == _DT_STRTAB:
+            strtab = val
+        elif tag == _DT_TEXTREL:
+            ret.textrel = True
+        elif tag == _DT_FLAGS and (val & _DF_TEXTREL):
+            ret.textrel = True
+
+    if strtab == None:
+        return ret
+
+    # the string table is given as an address, find it in the file
+    for vaddr, poff, fsz in loads:
+        if strtab >= vaddr and strtab < vaddr + fsz:
+            stroff = strtab - vaddr + poff
+            break
+    else:
+        return ret
+
+    ret.needed = [_cstr(mm, stroff + n) for n in needed]
+    if soname != None:
+        ret.soname = _cstr(mm, stroff + soname)
+
+    return ret
+
+# returns None if not an ELF file
+def parse(path):
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return None
+        with mm:
+            try:
+                return _parse(mm)
+            except (ValueError, struct.error):
+                # broken or truncated
+                return None
+
+def _files(root):
+    for dirp, dirs, files in os.walk(root):
+        for fn in files:
+            fp = os.path.join(dirp, fn)
+            st = os.lstat(fp)
+            # only regular files, in particular not following symlinks
+            if stat.S_ISREG(st.st_mode):
+                yield fp, st
+
+# scans the whole tree, returning the path of each ELF file (relative to
+# the root) along with its information
+#
+# the cache maps relative paths to the file identity and the result (None
+# for files that are not ELF), it is used for files that have not changed
+# and updated in place
+def scan(root, jobs = 1, cache = None):
+    root = str(root)
+
+    if cache == None:
+        cache = {}
+
+    ret = {}
+    seen = {}
+    fl = []
+
+    for fp, st in _files(root):
+        rp = os.path.relpath(fp, root)
+        # the change time cannot be set, so it also catches files that
+        # were replaced keeping the inode number, size and mtime
+        ident = [
+            st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+        ]
+        cached = cache.get(rp, None)
+        if cached and cached[0] == ident:
+            seen[rp] = cached
+            if cached[1]:
+                ret[rp] = cached[1]
+        else:
+            fl.append((fp, rp, ident))
+
+    if len(fl) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as ex:
+            for (fp, rp, ident), ef in zip(
+                fl, ex.map(parse, [f[0] for f in fl])
+            ):
+                seen[rp] = (ident, ef)
+                if ef:
+                    ret[rp] = ef
+
+    # drop whatever is gone
+    cache.clear()
+    cache.update(seen)
+
+    return ret
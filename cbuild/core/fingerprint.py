@@ -0,0 +1,122 @@
+# Build fingerprints, which identify everything that goes into a build:
+# the template directory (template, patches, files), the versions of the
+# installed build dependencies, the build profile and the parts of cbuild
+# that affect what is built.
+#
+# The fingerprint is stored next to every produced apk, so a package is
+# only considered fresh when none of its inputs have changed.
+
+from cbuild.core import paths
+from cbuild.apk import util as autil, index as apkidx
+
+import os
+import hashlib
+
+_code_hash = None
+
+# the parts of cbuild that go into the build output; commands, the server,
+# repository management and the like are left out
+_code_dirs = [
+    "build_profiles", "build_style", "hooks", "misc", "step", "util",
+    "wrappers",
+]
+_code_files = [
+    "core/build.py", "core/chroot.py", "core/elf.py", "core/profile.py",
+    "core/scanelf.py", "core/template.py", "apk/compress.py",
+    "apk/create.py", "apk/index.py", "apk/sign.py", "apk/util.py",
+]
+
+def _hash_file(md, fp, rel):
+    md.update(rel.encode() + b"\0")
+    if os.path.islink(fp):
+        md.update(b"l" + os.readlink(fp).encode() + b"\0")
+        return
+    with open(fp, "rb") as f:
+        md.update(b"f" + hashlib.sha256(f.read()).digest())
+
+def _hash_tree(md, path, prefix = ""):
+    for dirp, dirs, files in os.walk(path):
+        # compiled python is generated when templates and modules are loaded
+        if "__pycache__" in dirs:
+            dirs.remove("__pycache__")
+        dirs.sort()
+
+        for fn in sorted(files):
+            fp = os.path.join(dirp, fn)
+            _hash_file(md, fp, prefix + os.path.relpath(fp, path))
+
+def cbuild_hash():
+    global _code_hash
+
+    # it does not change during the run
+    if not _code_hash:
+        md = hashlib.sha256()
+        for d in _code_dirs:
+            _hash_tree(md, paths.cbuild() / d, d + "/")
+        for f in _code_files:
+            _hash_file(md, paths.cbuild() / f, f)
+        _code_hash = md.hexdigest()
+
+    return _code_hash
+
+def _dep_versions(md, deps, root):
+    db = apkidx.installed(root)
+
+    for dep in sorted(deps):
+        pn, pv, pop = autil.split_pkg_name(dep)
+        if not pn:
+            pn = dep
+        vers = []
+        if db:
+            vers = sorted([ent["V"] for ent in db.find(pn)])
+        md.update(f"{pn}={','.join(vers)}\0".encode())
+
+def compute(pkg):
+    md = hashlib.sha256()
+
+    md.update(b"template\0")
+    _hash_tree(md, pkg.template_path.resolve())
+
+    # host dependencies go in the build root, target dependencies may go
+    # in the sysroot when cross compiling; the build root is not given
+    # explicitly, as the dependencies may be installed in an overlay
+    if pkg.build_profile.cross:
+        sysp = paths.masterdir() / pkg.build_profile.sysroot.relative_to("/")
+    else:
+        sysp = None
+
+    md.update(b"\0hostdeps\0")
+    _dep_versions(md, pkg.hostmakedepends, None)
+    md.update(b"\0deps\0")
+    _dep_versions(md, pkg.makedepends, sysp)
+
+    md.update(b"\0profile\0")
+    md.update(pkg.build_profile.identity().encode())
+    md.update(f"\0dbg:{pkg.build_dbg}\0".encode())
+
+    md.update(b"\0cbuild\0")
+    md.update(cbuild_hash().encode())
+
+    return md.hexdigest()
+
+def path_for(binpath):
+    return binpath.with_suffix(binpath.suffix + ".fingerprint")
+
+def write(binpath, fprint):
+    fpath = path_for(binpath)
+    tpath = fpath.with_name(fpath.name + ".tmp")
+
+    with open(tpath, "w") as f:
+        f.write(fprint + "\n")
+
+    os.replace(tpath, fpath)
+
+def is_fresh(binpath, fprint):
+    if not fprint or not binpath.is_file():
+        return False
+
+    try:
+        with open(path_for(binpath)) as f:
+            return f.read().strip() == fprint
+    except FileNotFoundError:
+        return False
@@ -0,0 +1,186 @@
+# Provides git information about template directories (last revision,
+# its commit date and whether there are local modifications).
+#
+# Instead of running git for every template, the status is read once and
+# the history is walked rather than searched for every path; the walk is
+# lazy and only goes as far back as needed, remembering everything it has
+# seen on the way, and is stopped with close() once no longer needed.
+#
+# As the whole history is walked without a pathspec, merges are not
+# simplified the way git log -- <path> would, i.e. the revision is the
+# most recent commit (by date) that changed the path on any branch.
+
+import os
+import shutil
+import pathlib
+import subprocess
+
+class _Repo:
+    def __init__(self, toplevel):
+        self.toplevel = toplevel
+        # directory -> (revision, commit date)
+        self.revs = {}
+        self.modified = []
+        self.untracked = []
+        self.log = None
+        self.cur = None
+        self.done = False
+
+        st = subprocess.run([
+            "git", "-c", "core.quotepath=off", "status", "--porcelain", "-z"
+        ], capture_output = True, cwd = self.toplevel)
+
+        if st.returncode != 0:
+            return
+
+        ents = st.stdout.decode().split("\0")
+        i = 0
+        while i < len(ents):
+            ent = ents[i]
+            i += 1
+            if len(ent) < 4:
+                continue
+            if ent.startswith("??"):
+                self.untracked.append(ent[3:])
+            else:
+                self.modified.append(ent[3:])
+            # renames and copies are followed by the original path
+            if ent[0] == "R" or ent[0] == "C":
+                self.modified.append(ents[i])
+                i += 1
+
+    def _covers(self, ent, rel):
+        if ent == rel or ent.startswith(rel + "/"):
+            return True
+        # untracked directories are listed as a whole
+        return ent.endswith("/") and rel.startswith(ent)
+
+    def is_dirty(self, rel):
+        for ent in self.modified + self.untracked:
+            if self._covers(ent, rel):
+                return True
+        return False
+
+    def is_untracked(self, rel):
+        for ent in self.untracked:
+            if self._covers(ent, rel):
+                return True
+        return False
+
+    def _walk(self, rel):
+        # nothing more to find
+        if self.done:
+            return
+
+        if not self.log:
+            self.log = subprocess.Popen([
+                "git", "-c", "core.quotepath=off", "log", "--no-renames",
+                "--name-only", "--format=%x00%H %ct"
+            ], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                cwd = self.toplevel, text = True)
+
+        for ln in self.log.stdout:
+            ln = ln.rstrip("\n")
+            if ln.startswith("\0"):
+                self.cur = tuple(ln[1:].split())
+                continue
+            if len(ln) == 0 or not self.cur:
+                continue
+            # the path and every directory on the way count as modified
+            dname = ln
+            while len(dname) > 0 and not dname in self.revs:
+                self.revs[dname] = self.cur
+                dname = os.path.dirname(dname)
+            if rel in self.revs:
+                return
+
+        # the whole history was seen
+        self.close()
+        self.done = True
+
+    def close(self):
+        if not self.log:
+            return
+
+        self.log.stdout.close()
+        self.log.terminate()
+        self.log.wait()
+        self.log = None
+        self.cur = None
+
+    def last_revision(self, rel):
+        # never committed, so there is no need to go through the history
+        if not rel in self.revs and not self.is_untracked(rel):
+            self._walk(rel)
+
+        return self.revs.get(rel, None)
+
+def _toplevel(path):
+    if not shutil.which("git"):
+        return None
+
+    top = subprocess.run([
+        "git", "rev-parse", "--show-toplevel"
+    ], capture_output = True, cwd = path)
+
+    if top.returncode != 0:
+        return None
+
+    return pathlib.Path(top.stdout.decode().strip())
+
+# parent directory -> toplevel, toplevel -> repository info
+_tops = {}
+_repos = {}
+_pid = None
+
+def _repo_for(path):
+    global _tops, _repos, _pid
+
+    # forked processes must not share the history walk
+    if _pid != os.getpid():
+        _tops = {}
+        _repos = {}
+        _pid = os.getpid()
+
+    path = pathlib.Path(path)
+    # directories of templates share the repository with their parent
+    parent = path.parent.resolve()
+
+    if not parent in _tops:
+        _tops[parent] = _toplevel(parent)
+
+    top = _tops[parent]
+    if not top:
+        return None, None
+
+    if not top in _repos:
+        _repos[top] = _Repo(top)
+
+    return _repos[top], str((parent / path.name).relative_to(top))
+
+# stops the history walks, they are started over when needed again
+def close():
+    # the walks of the parent process are not ours to stop
+    if _pid != os.getpid():
+        return
+
+    for repo in _repos.values():
+        repo.close()
+
+# returns (revision, commit date, dirty) for the given directory, or None
+# if not in a git repository or not committed yet
+def template_info(path):
+    repo, rel = _repo_for(path)
+    if not repo:
+        return None
+
+    rev = repo.last_revision(rel)
+    if not rev or len(rev) != 2 or len(rev[0]) != 40:
+        return None
+
+    try:
+        ts = int(rev[1])
+    except ValueError:
+        ts = None
+
+    return rev[0], ts, repo.is_dirty(rel)
@@ -0,0 +1,232 @@
+# Caches build dependencies installed into an overlay as reusable layers.
+#
+# A layer is the upper directory of a build overlay right after the build
+# dependencies were installed, keyed by the base masterdir and the exact
+# versions of all packages that went in. Builds that would install the
+# very same set just stack the layer on top of the masterdir instead.
+#
+# Layers live in the hostdir and are evicted least recently used first
+# once the total size goes over the configured limit.
+
+from cbuild.core import paths, logger, chroot, version
+from cbuild.apk import util as autil, index as apkidx
+
+import os
+import fcntl
+import shutil
+import hashlib
+
+# in bytes, zero means disabled
+_limit = 0
+
+def set_limit(mib):
+    global _limit
+    _limit = mib * 1024 * 1024
+
+def enabled():
+    return _limit > 0
+
+def _layerdir():
+    return paths.hostdir() / "layers"
+
+# the packages (name -> version) that installing the given dependencies
+# on top of the masterdir is going to add, or None if it cannot be told
+def _closure(pkg, deps):
+    base = apkidx.installed(paths.masterdir())
+    dbs = apkidx.repositories(pkg)
+
+    ret = {}
+    queue = list(deps)
+
+    while len(queue) > 0:
+        dep = queue.pop()
+        # conflicts
+        if dep.startswith("!"):
+            continue
+
+        pn, pv, pop = autil.split_pkg_name(dep)
+        if not pn:
+            pn = dep
+            pattern = None
+        else:
+            pattern = dep
+
+        if base and base.has(pn):
+            continue
+
+        best = None
+        for db in dbs:
+            for ent in db.find(pn):
+                if pattern and ent["P"] == pn and not version.match(
+                    f"{pn}-{ent['V']}", pattern
+                ):
+                    continue
+                if not best or version.compare(ent["V"], best["V"]) > 0:
+                    best = ent
+
+        if not best:
+            return None
+
+        if best["P"] in ret:
+            continue
+
+        ret[best["P"]] = best["V"]
+        queue += best.get("D", "").split()
+
+    return ret
+
+def _added(root):
+    base = apkidx.installed(paths.masterdir())
+    db = apkidx.installed(root)
+    if not db:
+        return {}
+
+    ret = {}
+    for pn, ents in db.names.items():
+        # the virtual packages are a part of the key already
+        if pn == "autodeps-host" or pn == "autodeps-target":
+            continue
+        for ent in ents:
+            if base and ent in base.names.get(pn, []):
+                continue
+            ret[pn] = ent["V"]
+
+    return ret
+
+# returns the cache key for the given dependencies along with the expected
+# contents, or (None, None) when the result is not predictable
+def key_for(pkg, hostdeps, deps):
+    cl = _closure(pkg, hostdeps + deps)
+    if cl == None:
+        return None, None
+
+    md = hashlib.sha256()
+
+    with open(paths.masterdir() / "usr/lib/apk/db/installed", "rb") as f:
+        md.update(hashlib.sha256(f.read()).digest())
+
+    md.update(("\0host\0" + "\0".join(sorted(hostdeps))).encode())
+    md.update(("\0target\0" + "\0".join(sorted(deps))).encode())
+
+    for pn in sorted(cl):
+        md.update(f"\0{pn}-{cl[pn]}".encode())
+
+    return md.hexdigest(), cl
+
+def _lock(lpath, flags):
+    lockf = open(lpath / "lock", "a")
+    try:
+        fcntl.flock(lockf, flags)
+    except OSError:
+        lockf.close()
+        return None
+    return lockf
+
+# stack a cached layer on top of the masterdir; the layer is kept from
+# being evicted for as long as the overlay is in use
+def use(key):
+    lpath = _layerdir() / key
+
+    try:
+        lockf = _lock(lpath, fcntl.LOCK_SH)
+    except FileNotFoundError:
+        return False
+
+    if not lockf:
+        return False
+
+    # evicted while we were waiting
+    if not (lpath / "root").is_dir():
+        lockf.close()
+        return False
+
+    # the directory mtime is the last use
+    os.utime(lpath)
+
+    chroot.push_overlay_layer(lpath / "root", lockf)
+
+    return True
+
+def _tree_size(path):
+    ret = 0
+    for dirp, dirs, files in os.walk(path):
+        for f in dirs + files:
+            ret += os.lstat(os.path.join(dirp, f)).st_blocks * 512
+    return ret
+
+# turn the current upper directory into a layer, provided it contains
+# exactly what was expected
+def store(key, closure):
+    upper = chroot.overlay_upper()
+
+    if _added(upper) != closure:
+        logger.get().warn("cbuild: unexpected dependency set, not caching")
+        return False
+
+    ldir = _layerdir()
+    ldir.mkdir(parents = True, exist_ok = True)
+
+    lpath = ldir / key
+    tpath = ldir / f"{key}.tmp{os.getpid()}"
+
+    tpath.mkdir()
+    try:
+        os.rename(upper, tpath / "root")
+    except OSError:
+        # e.g. the hostdir is on a different filesystem
+        logger.get().warn("cbuild: cannot move overlay into the layer cache")
+        shutil.rmtree(tpath)
+        return False
+
+    with open(tpath / "size", "w") as sf:
+        sf.write(f"{_tree_size(tpath / 'root')}\n")
+
+    lockf = _lock(tpath, fcntl.LOCK_SH)
+
+    try:
+        os.rename(tpath, lpath)
+    except OSError:
+        # stored by a concurrent build in the meantime, just use that
+        lockf.close()
+        chroot.remove_tree(tpath)
+        if not use(key):
+            logger.get().out_red("cbuild: dependency layer went away")
+            raise Exception()
+        return True
+
+    # stack it instead of the old upper
+    chroot.push_overlay_layer(lpath / "root", lockf)
+
+    _evict()
+
+    return True
+
+def _evict():
+    layers = []
+    total = 0
+
+    for lpath in _layerdir().iterdir():
+        # temporary ones are named after the key plus a suffix
+        if "." in lpath.name or not (lpath / "size").is_file():
+            continue
+        try:
+            lsize = int((lpath / "size").read_text())
+        except ValueError:
+            lsize = 0
+        layers.append((lpath.stat().st_mtime, lsize, lpath))
+        total += lsize
+
+    layers.sort()
+
+    for mt, lsize, lpath in layers:
+        if total <= _limit:
+            break
+        # in use by a build
+        lockf = _lock(lpath, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not lockf:
+            continue
+        dpath = lpath.with_name(f"{lpath.name}.del{os.getpid()}")
+        os.rename(lpath, dpath)
+        lockf.close()
+        chroot.remove_tree(dpath)
+        total -= lsize
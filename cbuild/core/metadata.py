@@ -0,0 +1,128 @@
+# Provides a persistent cache of template metadata, so that things that
+# only need to know about templates (versions, dependencies and so on)
+# do not have to execute them every time.
+#
+# The cache lives in the hostdir and every entry is keyed by the hash of
+# the template file, the cbuild code and the build profile (including the
+# flags from the configuration), so it is invalidated as soon as anything
+# that goes into parsing the template changes. Templates that fail to parse
+# are never cached.
+
+from cbuild.core import paths, profile, chroot, fingerprint
+
+import os
+import json
+import sqlite3
+import hashlib
+
+# bump whenever the stored data changes or is computed differently
+_schema = 3
+
+_conn = None
+_conn_pid = None
+
+# when refreshing, cached entries are not used but rewritten, once per run
+_refresh = False
+_refreshed = {}
+
+def set_refresh(refresh):
+    global _refresh
+    _refresh = refresh
+
+def _db():
+    global _conn, _conn_pid
+
+    # connections must not be shared with forked processes
+    if _conn and _conn_pid == os.getpid():
+        return _conn
+
+    paths.hostdir().mkdir(parents = True, exist_ok = True)
+
+    _conn = sqlite3.connect(paths.hostdir() / "metadata.db", timeout = 60)
+    _conn_pid = os.getpid()
+    _conn.execute("""
+        CREATE TABLE IF NOT EXISTS templates (
+            name TEXT NOT NULL,
+            arch TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (name, arch)
+        )
+    """)
+    _conn.commit()
+
+    return _conn
+
+def _template_hash(pkgname, arch):
+    with open(paths.distdir() / pkgname / "template.py", "rb") as tf:
+        md = hashlib.sha256(tf.read())
+
+    prof = profile.get_profile(arch if arch else "bootstrap")
+
+    md.update(f"\0{_schema}\0".encode())
+    md.update(fingerprint.cbuild_hash().encode())
+    md.update(f"\0{prof.identity()}\0{chroot.host_cpu()}".encode())
+
+    return md.hexdigest()
+
+def _collect(pkg):
+    return {
+        "pkgname": pkg.pkgname,
+        "repository": pkg.repository,
+        "version": pkg.version,
+        "revision": pkg.revision,
+        "depends": pkg.depends,
+        "makedepends": pkg.makedepends,
+        "hostmakedepends": pkg.hostmakedepends,
+        "provides": pkg.provides,
+        "shlib_provides": pkg.shlib_provides,
+        "subpackages": [
+            {
+                "pkgname": sp.pkgname,
+                "depends": sp.depends,
+                "provides": sp.provides,
+                "shlib_provides": sp.shlib_provides,
+            } for sp in pkg.subpkg_list
+        ],
+        "options": pkg.options,
+        "archs": pkg.archs,
+    }
+
+# get the metadata of a template for the given architecture (None when
+# bootstrapping); template resolution is the same as in read_pkg
+def get(pkgname, arch, resolve = None, ignore_missing = False):
+    from cbuild.core import template
+
+    pkgname = template.resolve_pkgname(pkgname, resolve, ignore_missing)
+    if not pkgname:
+        return None
+
+    darch = arch if arch else ""
+    thash = _template_hash(pkgname, arch)
+
+    db = _db()
+
+    row = db.execute(
+        "SELECT data FROM templates WHERE name = ? AND arch = ? AND hash = ?",
+        (pkgname, darch, thash)
+    ).fetchone()
+
+    if row and (not _refresh or (pkgname, darch) in _refreshed):
+        return json.loads(row[0])
+
+    # not cached or stale, we need to parse it
+    pkg = template.read_pkg(
+        pkgname, arch, False, False, False, 1, False, False, None,
+        reproducible = False
+    )
+
+    ret = _collect(pkg)
+    _refreshed[(pkgname, darch)] = True
+
+    db.execute(
+        "INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?)",
+        (pkgname, darch, thash, json.dumps(ret))
+    )
+    db.commit()
+
+    return ret
@@ -23,6 +23,16 @@ def reinit_masterdir(masterdir, stage):
         oname = masterdir.name
         _mdir = masterdir.with_name(f"{oname}-stage{stage}")
 
+def set_masterdir(masterdir):
+    global _mdir
+    _mdir = masterdir
+
+# additional masterdirs used for concurrent builds, slot 0 is the main one
+def slot_masterdir(slot):
+    if slot == 0:
+        return _mdir
+    return _mdir.with_name(f"{_mdir.name}-slot{slot}")
+
 def set_stage(stage):
     global _stage
     _stage = stage
@@ -37,6 +37,9 @@ def remove_pkg(pkg):
         (pkg.statedir / f"{spkg.pkgname}_{crossb}_prepkg_done").unlink(
             missing_ok = True
         )
+        (pkg.statedir / f"{spkg.pkgname}_elf_cache.json").unlink(
+            missing_ok = True
+        )
 
     remove_spkg(pkg, pkg.destdir_base)
     for sp in pkg.subpkg_list:
@@ -271,6 +271,17 @@ class Profile:
     def cross(self):
         return self._arch != chroot.host_cpu()
 
+    # everything in the profile that affects the resulting packages
+    def identity(self):
+        return shlex.join(
+            [self._arch, str(self._triplet), self._endian, str(self._wordsize)]
+            + ["hardening:"] + self._hardening
+            + ["cflags:"] + self._cflags
+            + ["cxxflags:"] + self._cxxflags
+            + ["fflags:"] + self._fflags
+            + ["ldflags:"] + self._ldflags
+        )
+
 _all_profiles = {}
 
 def init(cparser):
@@ -1,54 +1,74 @@
-import subprocess
-import pathlib
+from cbuild.core import elf
 
-def scan(pkg, somap):
-    scandir = pkg.destdir
+import os
+import json
+import collections
+
+# what is known about every ELF file in the package and its subpackages
+ElfInfo = collections.namedtuple("ElfInfo", [
+    "soname", "needed", "pname", "static", "machine", "etype", "interp",
+    "textrel",
+])
+
+# the scan results are kept in the statedir, so that resumed builds and
+# later phases only need to look at new or modified files
+_cache_version = 2
+
+def _cache_path(pkg):
+    return pkg.statedir / f"{pkg.pkgname}_elf_cache.json"
+
+def _read_cache(pkg):
+    try:
+        with open(_cache_path(pkg)) as cf:
+            data = json.load(cf)
+        if data.get("version", None) != _cache_version:
+            return {}
+        ret = {}
+        for fp, (ident, ef) in data["files"].items():
+            ret[fp] = (ident, elf.load(ef) if ef else None)
+        return ret
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return {}
 
-    # %o: type, %t: textrels status, %n: needed, %S: soname
-    scanout = subprocess.run(
-        [
-            "scanelf", "--nobanner", "--nocolor", "--recursive", "--symlink",
-            "--format", "%a|%b|%o|%t|%n|%S|", pkg.destdir
-        ],
-        capture_output = True
-    )
+def _write_cache(pkg, cache):
+    cpath = _cache_path(pkg)
+    tpath = cpath.with_name(cpath.name + ".tmp")
 
-    if scanout.returncode != 0:
-        pkg.error("failed to scan shlibs")
+    files = {}
+    for fp, (ident, ef) in cache.items():
+        files[fp] = (ident, elf.dump(ef) if ef else None)
+
+    with open(tpath, "w") as cf:
+        json.dump({"version": _cache_version, "files": files}, cf)
+
+    os.replace(tpath, cpath)
+
+def scan(pkg, somap):
+    cache = _read_cache(pkg)
+    elfs = elf.scan(pkg.destdir, pkg.rparent.conf_jobs, cache)
+    _write_cache(pkg, cache)
 
     elf_usrshare = []
     elf_textrels = []
 
-    for ln in scanout.stdout.splitlines():
-        mtype, bind, stp, textrel, needed, soname, fpath = ln.split(b"|")
+    for fpath in sorted(elfs):
+        ef = elfs[fpath]
         # elf used as container files
-        if mtype.strip() == b"EM_NONE":
+        if ef.machine == elf.EM_NONE:
             continue
         # object files
-        if stp.strip() == b"ET_REL":
+        if ef.etype == elf.ET_REL:
             continue
-        # get file
-        fpath = pathlib.Path(fpath.strip().decode()).relative_to(pkg.destdir)
         # deny /usr/share files
-        if fpath.is_relative_to("usr/share"):
+        if fpath.startswith("usr/share/"):
             elf_usrshare.append(fpath)
         # check textrels
-        if textrel.strip() != b"-" and not pkg.rparent.options["textrels"]:
+        if ef.textrel and not pkg.rparent.options["textrels"]:
             elf_textrels.append(fpath)
-        # get a list
-        needed = needed.strip().decode()
-        if len(needed) == 0:
-            needed = []
-        else:
-            needed = needed.split(",")
-        # sanitize
-        if len(soname) == 0:
-            soname = None
-        else:
-            soname = soname.decode()
         # write
-        somap[str(fpath)] = (
-            soname, needed, pkg.pkgname, bind.strip() == b"STATIC"
+        somap[fpath] = ElfInfo(
+            ef.soname, ef.needed, pkg.pkgname, ef.static, ef.machine,
+            ef.etype, ef.interp, ef.textrel
         )
 
     # some linting
@@ -0,0 +1,372 @@
+# A build server, which keeps cbuild initialized (configuration, profiles,
+# hooks) and runs builds requested over a local unix socket.
+#
+# Requests and replies are JSON objects, one per line:
+#
+#   {"op": "build", "target": "main/foo", "step": "pkg", "arch": "..."}
+#   {"op": "status"} or {"op": "status", "id": N}
+#   {"op": "log", "id": N, "follow": true}
+#   {"op": "claim", "key": "..."}
+#
+# Every reply has an "ok" field, failed ones also have an "error". Logs are
+# streamed as {"line": "..."} objects, followed by the final job status.
+#
+# Jobs are queued and run in forked processes, each in its own masterdir
+# (the same slots that concurrent dependency builds use), and the number
+# of jobs running at the same time is limited globally. The server itself
+# is threaded, so the jobs are forked by a launcher process which is forked
+# before any threads are started.
+#
+# Jobs claim their target and every dependency they build for the time of
+# the build, the claim is only granted once no other job holds it and
+# released when the connection is closed, so the same template is never
+# built by two jobs at once.
+
+from cbuild.core import logger, paths, template, dependencies
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import contextlib
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.connection as mpconn
+
+_steps = {
+    "fetch": True, "extract": True, "patch": True, "configure": True,
+    "build": True, "check": True, "install": True, "pkg": True,
+}
+
+class Job:
+    def __init__(self, jid, target, step, arch, logpath):
+        self.id = jid
+        self.target = target
+        self.step = step
+        self.arch = arch
+        self.log = logpath
+        self.state = "queued"
+        self.slot = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+    def status(self):
+        return {
+            "id": self.id,
+            "target": self.target,
+            "step": self.step,
+            "arch": self.arch,
+            "state": self.state,
+            "queued": self.queued,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+    @property
+    def done(self):
+        return self.state == "done" or self.state == "failed"
+
+# claims the given dependency from the server, waiting until granted
+@contextlib.contextmanager
+def _claimed(sockpath, key):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(sockpath))
+        req = {"op": "claim", "key": f"{key[0]}:{key[1]}"}
+        sock.sendall((json.dumps(req) + "\n").encode())
+        with sock.makefile("r") as rf:
+            rep = json.loads(rf.readline() or "{}")
+        if not rep.get("ok", False):
+            raise Exception(f"failed to claim {key[0]}: {rep.get('error')}")
+        yield
+
+def _run_job(job, runner, sockpath, lconn):
+    # only for the launcher
+    lconn.close()
+
+    # everything the build outputs goes in the log
+    logf = os.open(job.log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    nullf = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(nullf, 0)
+    os.dup2(logf, 1)
+    os.dup2(logf, 2)
+    os.close(nullf)
+    os.close(logf)
+
+    sys.stdout.reconfigure(line_buffering = True)
+    sys.stderr.reconfigure(line_buffering = True)
+
+    dependencies.set_claim(lambda key: _claimed(sockpath, key))
+
+    try:
+        dependencies.use_masterdir(paths.slot_masterdir(job.slot), False)
+        # the same key as when built as a dependency
+        with _claimed(sockpath, dependencies.node_key(job.target, job.arch)):
+            runner(job.step, job.target, job.arch)
+    except template.SkipPackage:
+        pass
+    except:
+        logger.get().out_red(f"cbuild: failed to build {job.target}")
+        traceback.print_exc(file = logger.get().estream)
+        sys.exit(1)
+
+# forks the jobs it gets from the server, reporting back their exit codes;
+# exits once the server goes away, terminating whatever is still running
+def _launch(conn, sconn, runner, sockpath):
+    ctx = multiprocessing.get_context("fork")
+    running = {}
+
+    # the end of the server, which would keep the connection open
+    sconn.close()
+
+    while True:
+        for sent in mpconn.wait([conn] + list(running.keys())):
+            if sent == conn:
+                try:
+                    job = conn.recv()
+                except EOFError:
+                    for jid, proc in running.values():
+                        proc.terminate()
+                    return
+                proc = ctx.Process(
+                    target = _run_job, args = (job, runner, sockpath, conn)
+                )
+                # pending output would end up in the log of the job otherwise
+                sys.stdout.flush()
+                sys.stderr.flush()
+                proc.start()
+                running[proc.sentinel] = (job.id, proc)
+                continue
+            jid, proc = running.pop(sent)
+            proc.join()
+            conn.send((jid, proc.exitcode))
+
+class Server:
+    def __init__(self, sockpath, runner, jobs, arch):
+        self.sockpath = sockpath
+        self.runner = runner
+        # for jobs that do not specify one
+        self.arch = arch
+        self.logdir = paths.hostdir() / "serve"
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.queue = []
+        self.slots = list(range(jobs))
+        self.next_id = 1
+        # dependencies being built, see above
+        self.claims = {}
+        self.launcher = None
+        self.stopping = False
+        # wakes up the scheduler when new jobs come in
+        self.wake_r, self.wake_w = os.pipe()
+
+    def submit(self, target, step, arch):
+        with self.cond:
+            job = Job(
+                self.next_id, target, step, arch or self.arch,
+                self.logdir / f"{self.next_id}.log"
+            )
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            os.write(self.wake_w, b"\0")
+
+        logger.get().out(f"cbuild: queued job {job.id} ({target})")
+
+        return job
+
+    def _start(self):
+        while len(self.queue) > 0 and len(self.slots) > 0:
+            job = self.queue.pop(0)
+            job.slot = self.slots.pop(0)
+            job.state = "running"
+            job.started = time.time()
+            self.launcher.send(job)
+            logger.get().out(f"cbuild: started job {job.id} ({job.target})")
+
+    def _schedule(self):
+        while True:
+            with self.cond:
+                self._start()
+
+            sents = mpconn.wait([self.wake_r, self.launcher])
+
+            if self.wake_r in sents:
+                os.read(self.wake_r, 4096)
+
+            with self.cond:
+                if self.stopping:
+                    return
+
+            if not self.launcher in sents:
+                continue
+
+            try:
+                jid, code = self.launcher.recv()
+            except EOFError:
+                # nothing can be built anymore, so shut down
+                logger.get().out_red("cbuild: job launcher went away")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+            with self.cond:
+                job = self.jobs[jid]
+                job.state = "done" if code == 0 else "failed"
+                job.finished = time.time()
+                self.slots.append(job.slot)
+                logger.get().out(f"cbuild: job {job.id} {job.state}")
+                self.cond.notify_all()
+
+    def _claim(self, key, held):
+        with self.cond:
+            while key in self.claims:
+                self.cond.wait()
+            self.claims[key] = True
+            held.append(key)
+
+    def _release(self, held):
+        with self.cond:
+            for key in held:
+                self.claims.pop(key, None)
+            self.cond.notify_all()
+
+    def _stream_log(self, job, follow, send):
+        with open(job.log, "a+", errors = "replace") as logf:
+            logf.seek(0)
+            while True:
+                with self.cond:
+                    done = job.done
+                for ln in logf:
+                    send({"line": ln.rstrip("\n")})
+                if done or not follow:
+                    break
+                time.sleep(0.2)
+
+    def _job(self, req):
+        jid = req.get("id", None)
+        if not isinstance(jid, int):
+            return None
+        with self.cond:
+            return self.jobs.get(jid, None)
+
+    def _request(self, req, send, held):
+        op = req.get("op", None)
+
+        if op == "build":
+            target = req.get("target", None)
+            step = req.get("step", "pkg")
+            if not isinstance(target, str):
+                return {"ok": False, "error": "no target given"}
+            if not step in _steps:
+                return {"ok": False, "error": f"invalid step '{step}'"}
+            if not (paths.distdir() / target / "template.py").is_file():
+                return {"ok": False, "error": f"unknown template '{target}'"}
+            job = self.submit(target, step, req.get("arch", None))
+            return {"ok": True, "id": job.id}
+
+        if op == "status":
+            if "id" in req:
+                job = self._job(req)
+                if not job:
+                    return {"ok": False, "error": "unknown job"}
+                with self.cond:
+                    return {"ok": True, **job.status()}
+            with self.cond:
+                return {
+                    "ok": True,
+                    "jobs": [j.status() for j in self.jobs.values()],
+                }
+
+        if op == "log":
+            job = self._job(req)
+            if not job:
+                return {"ok": False, "error": "unknown job"}
+            self._stream_log(job, req.get("follow", False), send)
+            with self.cond:
+                return {"ok": True, **job.status()}
+
+        if op == "claim":
+            key = req.get("key", None)
+            if not isinstance(key, str):
+                return {"ok": False, "error": "no key given"}
+            self._claim(key, held)
+            return {"ok": True}
+
+        return {"ok": False, "error": f"invalid request '{op}'"}
+
+    def _client(self, conn):
+        def send(obj):
+            conn.sendall((json.dumps(obj) + "\n").encode())
+
+        # claims go away with the connection
+        held = []
+
+        try:
+            with conn, conn.makefile("r") as rf:
+                for ln in rf:
+                    if len(ln.strip()) == 0:
+                        continue
+                    try:
+                        req = json.loads(ln)
+                    except ValueError:
+                        send({"ok": False, "error": "malformed request"})
+                        continue
+                    if not isinstance(req, dict):
+                        send({"ok": False, "error": "malformed request"})
+                        continue
+                    send(self._request(req, send, held))
+        except OSError:
+            # client went away
+            pass
+        finally:
+            self._release(held)
+
+    def serve(self):
+        self.logdir.mkdir(parents = True, exist_ok = True)
+
+        # must be forked while there is only one thread
+        ctx = multiprocessing.get_context("fork")
+        self.launcher, lconn = ctx.Pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        lproc = ctx.Process(
+            target = _launch,
+            args = (lconn, self.launcher, self.runner, self.sockpath)
+        )
+        lproc.start()
+        lconn.close()
+
+        # stale socket from a previous run
+        if self.sockpath.is_socket():
+            self.sockpath.unlink()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(str(self.sockpath))
+        sock.listen()
+
+        sched = threading.Thread(target = self._schedule, daemon = True)
+        sched.start()
+
+        logger.get().out(f"cbuild: listening on {self.sockpath}")
+
+        try:
+            while True:
+                conn, addr = sock.accept()
+                threading.Thread(
+                    target = self._client, args = (conn,), daemon = True
+                ).start()
+        finally:
+            sock.close()
+            self.sockpath.unlink(missing_ok = True)
+            # the scheduler must not be waiting on the launcher when it is
+            # closed, or the launcher would never know
+            with self.cond:
+                self.stopping = True
+            os.write(self.wake_w, b"\0")
+            sched.join()
+            # the launcher terminates the running jobs
+            self.launcher.close()
+            lproc.join()
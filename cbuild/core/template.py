@@ -20,7 +20,7 @@ import shutil
 import builtins
 import configparser
 
-from cbuild.core import logger, chroot, paths, version, profile
+from cbuild.core import logger, chroot, paths, version, profile, git
 from cbuild.apk import cli
 
 class PackageError(Exception):
@@ -169,6 +169,8 @@ class Package:
         self.logger = logger.get()
         self.pkgname = None
         self.pkgver = None
+        # binary packages that were already identical and kept
+        self.kept_binpkgs = set()
 
     def log(self, msg, end = "\n"):
         self.logger.out(self._get_pv() + ": " + msg, end)
@@ -396,6 +398,31 @@ def copy_of_dval(val):
         return dict(val)
     return val
 
+# all repositories templates in the given repository can depend on
+def source_repositories(repo):
+    ret = [repo]
+    crepo = repo
+    # the toplevel repo is already added
+    while True:
+        # check if the current repo has a parent link
+        rp = paths.distdir() / crepo / ".parent"
+        if not rp.is_symlink():
+            break
+        # try resolving it, if it resolves, consider it
+        try:
+            rp = rp.readlink()
+        except:
+            break
+        # it resolved, consider the name
+        crepo = rp.name
+        # skip if it does not resolve to a repository
+        if not (paths.distdir() / crepo).is_dir():
+            break
+        # append and repeat
+        ret.append(crepo)
+
+    return ret
+
 def pkg_profile(pkg, target):
     if pkg.bootstrapping and (target == "host" or target == "target"):
         return profile.get_profile("bootstrap")
@@ -425,26 +452,7 @@ class Template(Package):
         self.repository, self.pkgname = pkgname.split("/")
 
         # resolve all source repos available to this package
-        self.source_repositories = [self.repository]
-        crepo = self.repository
-        # the toplevel repo is already added
-        while True:
-            # check if the current repo has a parent link
-            rp = paths.distdir() / crepo / ".parent"
-            if not rp.is_symlink():
-                break
-            # try resolving it, if it resolves, consider it
-            try:
-                rp = rp.readlink()
-            except:
-                break
-            # it resolved, consider the name
-            crepo = rp.name
-            # skip if it does not resolve to a repository
-            if not (paths.distdir() / crepo).is_dir():
-                break
-            # append and repeat
-            self.source_repositories.append(crepo)
+        self.source_repositories = source_repositories(self.repository)
 
         # other fields
         self.parent = None
@@ -453,54 +461,29 @@ class Template(Package):
         self.source_date_epoch = None
         self.git_revision = None
         self.git_dirty = False
+        self.fingerprint = None
         self.current_sonames = {}
+        # shared library providers by soname, for runtime dependencies
+        self.shlib_providers = None
         self.default_hardening = []
 
     def setup_reproducible(self):
         self.source_date_epoch = int(time.time())
 
-        if not shutil.which("git"):
-            # no git, not reproducible
-            return
-
-        if subprocess.run([
-            "git", "rev-parse", "--show-toplevel"
-        ], capture_output = True, cwd = self.template_path).returncode != 0:
-            # not in a git repository
+        ginfo = git.template_info(self.template_path)
+        if not ginfo:
+            # not in a git repository or never committed, not reproducible
             return
 
-        # find whether the template dir has local modifications
-        dirty = len(subprocess.run([
-            "git", "status", "-s", "--", self.template_path
-        ], capture_output = True).stdout.strip()) != 0
-
-        # find the last revision modifying the template
-        self.git_revision = subprocess.run([
-            "git", "log", "--format=oneline", "-n1", "--", self.template_path
-        ], capture_output = True).stdout.strip()[0:40].decode("ascii")
-
-        if len(self.git_revision) < 40:
-            # ???
-            self.git_revision = None
-            return
-
-        self.git_dirty = dirty
+        self.git_revision, ts, self.git_dirty = ginfo
 
         # template directory modified, do not use a reproducible date
-        if dirty:
+        if self.git_dirty:
             return
 
-        # get the date of the git revision
-        ts = subprocess.run([
-            "git", "log", "-1", "--format=%cd",
-            "--date=unix", self.git_revision
-        ], capture_output = True).stdout.strip()
-
-        try:
-            self.source_date_epoch = int(ts)
-        except ValueError:
-            # ???
-            pass
+        # the date of the last revision modifying the template
+        if ts:
+            self.source_date_epoch = ts
 
     def ensure_fields(self):
         for fl, dval, tp, opt, mand, sp, inh in core_fields:
@@ -541,7 +524,7 @@ class Template(Package):
         if not matched:
             self.error(f"this package cannot be built for {archn}")
 
-    def do(self, cmd, args, env = {}, wrksrc = None):
+    def do(self, cmd, args, env = {}, wrksrc = None, stdout = None):
         cenv = {
             "CFLAGS": self.get_cflags(shell = True),
             "FFLAGS": self.get_fflags(shell = True),
@@ -595,7 +578,8 @@ class Template(Package):
             bootstrapping = self.bootstrapping, ro_root = True,
             ro_build = self.install_done,
             ro_dest = (self.current_phase != "install"),
-            mount_ccache = True, unshare_all = (self.current_phase != "fetch")
+            mount_ccache = True, unshare_all = (self.current_phase != "fetch"),
+            stdout = stdout
         )
 
     def stamp(self, name):
@@ -1150,12 +1134,8 @@ def from_module(m, ret):
 
 _tmpl_dict = {}
 
-def read_pkg(
-    pkgname, pkgarch, force_mode, skip_if_exist, run_check,
-    jobs, build_dbg, use_ccache, origin, resolve = None, ignore_missing = False
-):
-    global _tmpl_dict
-
+# get the full "repo/name" of a template without parsing it
+def resolve_pkgname(pkgname, resolve = None, ignore_missing = False):
     if not isinstance(pkgname, str):
         logger.get().out_red("Missing package name.")
         raise PackageError()
@@ -1163,18 +1143,26 @@ def read_pkg(
     if resolve:
         for r in resolve.source_repositories:
             if (paths.distdir() / r / pkgname / "template.py").is_file():
-                pkgname = f"{r}/{pkgname}"
-                break
-        else:
-            if ignore_missing:
-                return None
-            logger.get().out_red("Missing template for '%s'" % pkgname)
-            raise PackageError()
-    elif not (paths.distdir() / pkgname / "template.py").is_file():
-        if ignore_missing:
-            return None
-        logger.get().out_red("Missing template for '%s'" % pkgname)
-        raise PackageError()
+                return f"{r}/{pkgname}"
+    elif (paths.distdir() / pkgname / "template.py").is_file():
+        return pkgname
+
+    if ignore_missing:
+        return None
+
+    logger.get().out_red("Missing template for '%s'" % pkgname)
+    raise PackageError()
+
+def read_pkg(
+    pkgname, pkgarch, force_mode, skip_if_exist, run_check,
+    jobs, build_dbg, use_ccache, origin, resolve = None, ignore_missing = False,
+    reproducible = True
+):
+    global _tmpl_dict
+
+    pkgname = resolve_pkgname(pkgname, resolve, ignore_missing)
+    if not pkgname:
+        return None
 
     ret = Template(pkgname, origin)
     ret.template_path = paths.distdir() / pkgname
@@ -1186,7 +1174,10 @@ def read_pkg(
     ret.use_ccache = use_ccache
     ret.conf_jobs = jobs
 
-    ret.setup_reproducible()
+    # not needed when only reading metadata
+    if reproducible:
+        ret.setup_reproducible()
+        git.close()
 
     if pkgarch:
         ret.build_profile = profile.get_profile(pkgarch)
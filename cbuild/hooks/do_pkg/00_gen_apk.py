@@ -1,6 +1,7 @@
-from cbuild.core import logger, paths
-from cbuild.apk import create as apk_c, sign as apk_s
+from cbuild.core import logger, paths, fingerprint
+from cbuild.apk import create as apk_c, sign as apk_s, manifest as apk_m
 
+import os
 import glob
 import time
 import pathlib
@@ -27,19 +28,23 @@ def genpkg(
 
     repo.mkdir(parents = True, exist_ok = True)
 
-    while lockpath.is_file():
-        pkg.log_warn(f"binary package being created, waiting...")
-        time.sleep(1)
+    # the lock file is created atomically, as packages may be generated
+    # by several processes at the same time
+    while True:
+        try:
+            os.close(os.open(lockpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            break
+        except FileExistsError:
+            pkg.log_warn(f"binary package being created, waiting...")
+            time.sleep(1)
 
-    if binpath.is_file():
-        tmt = (pkg.rparent.template_path / "template.py").stat().st_mtime
-        if binpath.stat().st_mtime > tmt and not pkg.force_mode:
+    try:
+        fprint = pkg.rparent.fingerprint
+
+        if fingerprint.is_fresh(binpath, fprint) and not pkg.force_mode:
             pkg.log_warn(f"fresh binary package already exists, skipping...")
             return
 
-    try:
-        lockpath.touch()
-
         metadata = {}
         args = []
 
@@ -94,11 +99,25 @@ def genpkg(
         if dbg:
             pkgname += "-dbg"
 
-        apk_c.create(
+        csum = apk_c.create(
             pkgname, f"{pkg.version}-r{pkg.revision}", arch,
-            pkg.rparent.source_date_epoch, destdir, pkg.statedir, binpath,
+            pkg.rparent.source_date_epoch, destdir, binpath,
             pkg.rparent.signing_key, metadata
         )
+
+        if csum:
+            apk_m.add(
+                repo, binpkg, pkgname, f"{pkg.version}-r{pkg.revision}", csum
+            )
+        else:
+            logger.get().out(f"Identical {binpkg} already exists, keeping it")
+            # nothing changed, so it does not need registering either
+            pkg.kept_binpkgs.add(binpkg)
+
+        if fprint:
+            fingerprint.write(binpath, fprint)
+        else:
+            fingerprint.path_for(binpath).unlink(missing_ok = True)
     finally:
         lockpath.unlink()
 
@@ -1,34 +1,107 @@
+from cbuild.core import elf
+
 import shutil
 import subprocess
 
-def make_debug(pkg, f, relf):
-    if not pkg.rparent.options["debug"] or not pkg.rparent.build_dbg:
-        return
-
-    dfile = pkg.destdir / "usr/lib/debug" / relf
-    cfile = pkg.chroot_destdir / "usr/lib/debug" / relf
-
-    dfile.parent.mkdir(parents = True, exist_ok = True)
-    try:
-        pkg.rparent.do(pkg.rparent.get_tool("OBJCOPY"), [
-            "--only-keep-debug", pkg.chroot_destdir / relf, cfile
-        ])
-    except:
-        pkg.error(f"failed to create dbg file for {relf}")
-
-    dfile.chmod(0o644)
+# runs the worker for each task, many at a time, in a single sandbox
+_batch = """
+w="$1"; t="$2"; j="$3"; shift 3
+exec xargs -0 -n 3 -P "$j" /bin/sh -c "$w" sh "$@" < "$t"
+"""
+
+# a single task: the mode, the file and the debug file ('-' if none); the
+# failed step is printed so that it can be reported the usual way, which is
+# the only output as the builddir is read-only by now
+_worker = """
+strip="$1"; objcopy="$2"; mode="$3"; file="$4"; dbg="$5"
+
+fail() {
+    printf "%s\\t%s\\n" "$1" "$file"
+    exit 1
+}
+
+if [ "$dbg" != "-" ]; then
+    "$objcopy" --only-keep-debug "$file" "$dbg" >&2 || fail dbg
+fi
+
+case "$mode" in
+    static) "$strip" --strip-debug "$file" >&2 || fail strip ;;
+    exec) "$strip" "$file" >&2 || fail strip ;;
+    *) "$strip" --strip-unneeded "$file" >&2 || fail strip ;;
+esac
+
+if [ "$dbg" != "-" ]; then
+    "$objcopy" --add-gnu-debuglink="$dbg" "$file" >&2 || fail link
+fi
+"""
+
+_errors = {
+    "dbg": "failed to create dbg file for",
+    "strip": "failed to strip",
+    "link": "failed to attach debug link to",
+}
+
+# strips everything in one go rather than entering the sandbox several
+# times for every file
+def run_tasks(pkg, strip_path, tasks):
+    sdir = pkg.rparent.statedir
+    csdir = pkg.rparent.chroot_builddir / sdir.relative_to(
+        pkg.rparent.builddir
+    )
+    tfile = f"{pkg.pkgname}_strip_tasks"
+
+    with open(sdir / tfile, "wb") as tf:
+        for mode, vr, dbg, msg in tasks:
+            if dbg:
+                (pkg.destdir / "usr/lib/debug" / vr).parent.mkdir(
+                    parents = True, exist_ok = True
+                )
+                cdbg = str(pkg.chroot_destdir / "usr/lib/debug" / vr)
+            else:
+                cdbg = "-"
+            cfile = str(pkg.chroot_destdir / vr)
+            tf.write(f"{mode}\0{cfile}\0{cdbg}\0".encode())
 
-def attach_debug(pkg, f, relf):
-    if not pkg.rparent.options["debug"] or not pkg.rparent.build_dbg:
-        return
+    some_failed = False
 
-    cfile = pkg.chroot_destdir / "usr/lib/debug" / relf
     try:
-        pkg.rparent.do(pkg.rparent.get_tool("OBJCOPY"), [
-            f"--add-gnu-debuglink={cfile}", pkg.chroot_destdir / relf
-        ])
-    except:
-        pkg.error(f"failed to attach debug link to {relf}")
+        out = pkg.rparent.do("/bin/sh", [
+            "-c", _batch, "sh", _worker, csdir / tfile,
+            str(pkg.rparent.conf_jobs), strip_path,
+            pkg.rparent.get_tool("OBJCOPY")
+        ], stdout = subprocess.PIPE).stdout
+    except subprocess.CalledProcessError as e:
+        # xargs exits with 123 when some of the workers failed, which are
+        # then reported below; anything else means the batch did not run
+        if e.returncode != 123:
+            (sdir / tfile).unlink(missing_ok = True)
+            pkg.error(f"failed to run strip (exit code {e.returncode})")
+        out = e.stdout
+        some_failed = True
+    except OSError as e:
+        (sdir / tfile).unlink(missing_ok = True)
+        pkg.error(f"failed to run strip: {e}")
+
+    (sdir / tfile).unlink(missing_ok = True)
+
+    failed = {}
+
+    for ln in (out or b"").decode().splitlines():
+        step, sep, cfile = ln.partition("\t")
+        if step in _errors:
+            failed[cfile] = step
+
+    # a worker failed without saying which step
+    if some_failed and len(failed) == 0:
+        pkg.error("failed to strip files")
+
+    for mode, vr, dbg, msg in tasks:
+        step = failed.get(str(pkg.chroot_destdir / vr), None)
+        if step:
+            pkg.error(f"{_errors[step]} {vr}")
+        if dbg:
+            (pkg.destdir / "usr/lib/debug" / vr).chmod(0o644)
+        print(f"   {msg}")
 
 def invoke(pkg):
     if not pkg.options["strip"]:
@@ -40,6 +113,10 @@ def invoke(pkg):
     elfs = pkg.rparent.current_elfs
 
     have_pie = pkg.rparent.has_hardening("pie")
+    have_dbg = pkg.rparent.options["debug"] and pkg.rparent.build_dbg
+
+    # (mode, relative path, whether to split debug info, message)
+    tasks = []
 
     for v in pkg.destdir.rglob("*"):
         # already stripped debug symbols
@@ -75,67 +152,36 @@ def invoke(pkg):
         if found_nostrip:
             continue
 
-        # now we've got a file we definitely can strip
-        cfile = str(pkg.chroot_destdir / vr)
-
         # strip static library
         if not vt:
             v.chmod(0o644)
-            try:
-                pkg.rparent.do(strip_path, ["--strip-debug", cfile])
-            except:
-                pkg.error(f"failed to strip {vr}")
-
-            print(f"   Stripped static library: {vr}")
+            tasks.append((
+                "static", vr, False, f"Stripped static library: {vr}"
+            ))
             continue
 
-        soname, needed, pname, static = vt
-
         # strip static executable
-        if static:
+        if vt.static:
             v.chmod(0o755)
-            try:
-                pkg.rparent.do(strip_path, [cfile])
-            except:
-                pkg.error(f"failed to strip {vr}")
-
-            print(f"   Stripped static executable: {vr}")
+            tasks.append((
+                "exec", vr, False, f"Stripped static executable: {vr}"
+            ))
             continue
 
-        # guess what it is
-        scanout = subprocess.run([
-            "scanelf", "--nobanner", "--nocolor",
-            "--format", "%a|%o|%i", v
-        ], capture_output = True)
-
-        if scanout.returncode != 0:
-            pkg.error(f"failed to scan {vr}")
-
-        # strip the filename
-        scanout = scanout.stdout.strip()[:-len(str(v)) - 1]
-
-        # get the type and interpreter
-        splitv = scanout.split(b"|")
-        if len(splitv) != 3:
-            pkg.error(
-                f"invalid scanelf output for {vr}: {scanout.encode()}"
-            )
-        mtype, etype, interp = splitv
-
         # may just be using ELF as a container format
-        if mtype.strip() == b"EM_NONE":
+        if vt.machine == elf.EM_NONE:
             print(f"   Ignoring ELF file with no machine: {vr}")
 
         # pie or nopie?
-        if etype == b"ET_DYN":
+        if vt.etype == elf.ET_DYN:
             pie = True
-        elif etype == b"ET_EXEC":
+        elif vt.etype == elf.ET_EXEC:
             pie = False
         else:
-            pkg.error(f"unknown type for {vr}: {etype.encode()}")
+            pkg.error(f"unknown type for {vr}: {vt.etype}")
 
         # executable or library?
-        dynlib = (len(interp.strip()) == 0)
+        dynlib = not vt.interp
 
         # sanity check
         if not pie and dynlib:
@@ -146,14 +192,6 @@ def invoke(pkg):
 
         # strip nopie executable
         if not pie:
-            make_debug(pkg, v, vr)
-            try:
-                pkg.rparent.do(strip_path, [cfile])
-            except:
-                pkg.error(f"failed to strip {vr}")
-
-            print(f"   Stripped executable: {vr}")
-
             allow_nopie = False
             if have_pie:
                 for f in pkg.nopie_files:
@@ -166,27 +204,24 @@ def invoke(pkg):
             if not allow_nopie:
                 pkg.error(f"non-PIE executable found in PIE build: {vr}")
 
-            attach_debug(pkg, v, vr)
+            tasks.append((
+                "exec", vr, have_dbg, f"Stripped executable: {vr}"
+            ))
             continue
 
         # strip pie executable or shared library
-        make_debug(pkg, v, vr)
-        try:
-            pkg.rparent.do(strip_path, ["--strip-unneeded", cfile])
-        except:
-            pkg.error(f"failed to strip {vr}")
-
         if not dynlib:
-            print(f"   Stripped position-independent executable: {vr}")
+            msg = f"Stripped position-independent executable: {vr}"
         else:
-            print(f"   Stripped library: {vr}")
+            msg = f"Stripped library: {vr}"
 
-        attach_debug(pkg, v, vr)
+        tasks.append(("dyn", vr, have_dbg, msg))
 
-        # strip shared library
+    if len(tasks) > 0:
+        run_tasks(pkg, strip_path, tasks)
 
     # prepare debug package
-    if not pkg.rparent.options["debug"] or not pkg.rparent.build_dbg:
+    if not have_dbg:
         return
 
     # no debug symbols found
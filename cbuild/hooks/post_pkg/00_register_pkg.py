@@ -1,5 +1,18 @@
 from cbuild.core import paths
 
+import fcntl
+
+def _register(pkg, repo, binpkg):
+    # kept as it was, so already in the index
+    if binpkg in pkg.kept_binpkgs:
+        return
+
+    rpath = pkg.statedir / f"{pkg.rparent.pkgname}_register_pkg"
+    # subpackages may be registered from several processes at once
+    with open(rpath, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(f"{repo}:{binpkg}\n")
+
 def invoke(pkg):
     arch = pkg.rparent.build_profile.arch
     binpkg = f"{pkg.pkgver}.apk"
@@ -10,8 +23,7 @@ def invoke(pkg):
     binpath = repo / binpkg
 
     if binpath.is_file():
-        with open(pkg.statedir / f"{pkg.rparent.pkgname}_register_pkg", "a") as f:
-            f.write(f"{repo}:{binpkg}\n")
+        _register(pkg, repo, binpkg)
 
     repo = paths.repository() / pkg.rparent.repository / "debug" / arch
     binpath = repo / binpkg_dbg
@@ -24,5 +36,4 @@ def invoke(pkg):
     ).is_dir():
         return
 
-    with open(pkg.statedir / f"{pkg.rparent.pkgname}_register_pkg", "a") as f:
-        f.write(f"{repo}:{binpkg_dbg}\n")
+    _register(pkg, repo, binpkg_dbg)
@@ -1,9 +1,36 @@
-from cbuild.core import logger, chroot, paths, version
-from cbuild.apk import cli
+from cbuild.core import logger, paths
+from cbuild.apk import index as apkidx
 
-import os
 import pathlib
-import subprocess
+
+# all shared libraries known to the build, by soname; built only once for
+# the main package and all its subpackages
+def _get_providers(pkg):
+    rp = pkg.rparent
+
+    if rp.shlib_providers != None:
+        return rp.shlib_providers
+
+    bp = rp.build_profile
+    if bp.cross:
+        broot = paths.masterdir() / bp.sysroot.relative_to("/")
+    else:
+        broot = None
+
+    # the database is read in-process, so that packages installed in
+    # a build overlay are seen as well
+    dbs = []
+    idb = apkidx.installed(broot)
+    if idb:
+        dbs.append(idb)
+
+    # when bootstrapping, also check the repository
+    if pkg.bootstrapping:
+        dbs += apkidx.repositories("main")
+
+    rp.shlib_providers = apkidx.shlib_providers(dbs)
+
+    return rp.shlib_providers
 
 def invoke(pkg):
     if not pkg.options["scanrdeps"]:
@@ -17,25 +44,24 @@ def invoke(pkg):
     for fp, finfo in curelf.items():
         fp = pathlib.Path(fp)
 
-        soname, needed, pname, static = finfo
-
-        if soname:
-            curso[soname] = pname
+        if finfo.soname:
+            curso[finfo.soname] = finfo.pname
         elif fp.suffix == ".so" and str(fp.parent) == "usr/lib":
-            curso[fp.name] = pname
+            curso[fp.name] = finfo.pname
 
         if ("/" + str(fp)) in pkg.skiprdeps:
             pkg.log(f"skipping dependency scan for {fp}")
             continue
 
-        if pname != pkg.pkgname:
+        if finfo.pname != pkg.pkgname:
             continue
 
-        for n in needed:
+        for n in finfo.needed:
             verify_deps[n] = True
 
-    broken = False
+    broken = []
     log = logger.get()
+    sodb = _get_providers(pkg)
 
     # FIXME: also emit dependencies for proper version constraints
     for dep in verify_deps:
@@ -50,58 +76,19 @@ def invoke(pkg):
                 log.out_plain(f"   SONAME: {dep} <-> {depn}")
                 pkg.so_requires.append(dep)
             continue
-        # otherwise, check if it came from an installed dependency
-        bp = pkg.rparent.build_profile
-        if bp.cross:
-            broot = paths.masterdir() / bp.sysroot.relative_to("/")
-            aarch = bp.arch
-        else:
-            broot = None
-            aarch = None
-
-        info = cli.call(
-            "info", ["--installed", "so:" + dep], None, root = broot,
-            capture_output = True, arch = aarch, allow_untrusted = True
-        )
-        if info.returncode != 0:
-            # when bootstrapping, also check the repository
-            if pkg.bootstrapping:
-                info = cli.call(
-                    "info", ["--description", "so:" + dep], "main",
-                    capture_output = True, allow_untrusted = True
-                )
-                # this needs a bit more parsing, first take only the name-ver
-                outl = info.stdout.split()
-                sdep = None
-                if len(outl) > 0:
-                    outl = outl[0].strip().decode()
-                    # find -rX
-                    dash = outl.rfind("-")
-                    if dash > 0:
-                        # find the version separator
-                        dash = outl.rfind("-", 0, dash)
-                        if dash > 0:
-                            # consider just the name
-                            sdep = outl[0:dash]
-            # either of the commands failed
-            if info.returncode != 0:
-                log.out_red(f"   SONAME: {dep} <-> UNKNOWN PACKAGE!")
-                broken = True
-                continue
-        else:
-            sdep = info.stdout.strip().decode()
-
-        if not sdep or len(sdep) == 0:
-            # this should never happen though
+        # otherwise, check if it came from a dependency
+        sdep = sodb.get(dep, None)
+        if not sdep:
+            # not provided by anything we know of
             log.out_red(f"   SONAME: {dep} <-> UNKNOWN PACKAGE!")
-            broken = True
+            broken.append(dep)
             continue
         # we found a package
         log.out_plain(f"   SONAME: {dep} <-> {sdep}")
         pkg.so_requires.append(dep)
 
-    if broken:
-        pkg.error("cannot guess required shlibs")
+    if len(broken) > 0:
+        pkg.error(f"cannot guess required shlibs: {', '.join(broken)}")
 
     # add any explicit deps
     pkg.so_requires += pkg.shlib_requires
@@ -39,10 +39,10 @@ def invoke(pkg):
     for fp, finfo in curelf.items():
         fp = pathlib.Path(fp)
 
-        soname, needed, pname, static = finfo
+        soname = finfo.soname
 
         # we only care about our own
-        if pname != pkg.pkgname:
+        if finfo.pname != pkg.pkgname:
             continue
 
         sfxs = fp.suffixes
@@ -0,0 +1,40 @@
+import io
+import gzip
+import random
+import unittest
+
+from cbuild.apk import compress
+
+def _compress(data, threads, chunk):
+    out = io.BytesIO()
+    gz = compress.GzipWriter(out, threads = threads)
+    for i in range(0, len(data), chunk):
+        gz.write(data[i:i + chunk])
+    gz.close()
+    return out.getvalue()
+
+class GzipWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.blocksize = compress._blocksize
+        compress.setup(1, 64 * 1024)
+
+        # partly compressible, spanning a good number of blocks
+        rnd = random.Random(0)
+        words = [rnd.randbytes(rnd.randint(1, 12)) for i in range(500)]
+        self.data = b" ".join(rnd.choice(words) for i in range(200000))
+
+    def tearDown(self):
+        compress.setup(1, self.blocksize)
+
+    def test_threads_same_output(self):
+        one = _compress(self.data, 1, 4096)
+        for threads in [2, 3, 8]:
+            self.assertEqual(_compress(self.data, threads, 10000), one)
+
+    def test_roundtrip(self):
+        for threads in [1, 4]:
+            out = _compress(self.data, threads, 65536)
+            self.assertEqual(gzip.decompress(out), self.data)
+
+    def test_empty(self):
+        self.assertEqual(gzip.decompress(_compress(b"", 4, 1)), b"")
@@ -0,0 +1,64 @@
+import os
+import struct
+import pathlib
+import tempfile
+import time
+import unittest
+
+from cbuild.core import elf
+
+# a minimal 64-bit little endian shared object without program headers
+def _elf(etype = elf.ET_DYN, machine = 62):
+    hdr = b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+    hdr += struct.pack(
+        "<HHIQQQIHHHHHH", etype, machine, 1, 0, 0, 0, 0, 64, 56, 0, 64, 0, 0
+    )
+    return hdr + bytes(64)
+
+class ScanCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmp.name)
+        (self.root / "usr/lib").mkdir(parents = True)
+        self.path = self.root / "usr/lib/libfoo.so.1"
+        self.path.write_bytes(_elf())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_unchanged_reused(self):
+        cache = {}
+        elf.scan(self.root, 1, cache)
+        ident, ef = cache["usr/lib/libfoo.so.1"]
+        ret = elf.scan(self.root, 1, cache)
+        # the very same object, i.e. not parsed again
+        self.assertIs(ret["usr/lib/libfoo.so.1"], ef)
+
+    def test_rewritten_in_place(self):
+        cache = {}
+        ret = elf.scan(self.root, 1, cache)
+        self.assertEqual(ret["usr/lib/libfoo.so.1"].etype, elf.ET_DYN)
+
+        st = self.path.stat()
+        # file times may only be updated once per clock tick
+        time.sleep(0.05)
+
+        # same inode, same size, same mtime, different contents
+        with open(self.path, "r+b") as f:
+            f.write(_elf(elf.ET_EXEC))
+        os.utime(self.path, ns = (st.st_atime_ns, st.st_mtime_ns))
+
+        nst = self.path.stat()
+        self.assertEqual(nst.st_ino, st.st_ino)
+        self.assertEqual(nst.st_size, st.st_size)
+        self.assertEqual(nst.st_mtime_ns, st.st_mtime_ns)
+
+        ret = elf.scan(self.root, 1, cache)
+        self.assertEqual(ret["usr/lib/libfoo.so.1"].etype, elf.ET_EXEC)
+
+    def test_removed_dropped(self):
+        cache = {}
+        elf.scan(self.root, 1, cache)
+        self.path.unlink()
+        self.assertEqual(elf.scan(self.root, 1, cache), {})
+        self.assertEqual(cache, {})
@@ -0,0 +1,70 @@
+import pathlib
+import tempfile
+import types
+import unittest
+
+from cbuild.core import paths, chroot, fingerprint
+
+_distdir = pathlib.Path(__file__).resolve().parent.parent
+
+class _Profile:
+    cross = False
+
+    def identity(self):
+        return "x86_64"
+
+def _write_db(root, ver):
+    dbp = root / "usr/lib/apk/db"
+    dbp.mkdir(parents = True, exist_ok = True)
+    (dbp / "installed").write_text(f"P:foo\nV:{ver}\nA:x86_64\n\n")
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = pathlib.Path(self.tmp.name)
+
+        paths.init(_distdir, tmp / "masterdir", tmp / "hostdir")
+
+        self.tmpl = tmp / "tmpl"
+        self.tmpl.mkdir()
+        (self.tmpl / "template.py").write_text("pkgname = 'bar'\n")
+
+        # the masterdir has the old version, the overlay the new one
+        _write_db(paths.masterdir(), "1.0-r0")
+
+        self.pkg = types.SimpleNamespace(
+            template_path = self.tmpl, build_profile = _Profile(),
+            build_dbg = False, bootstrapping = False,
+            hostmakedepends = ["foo"], makedepends = []
+        )
+
+        chroot.set_overlay(True)
+
+    def tearDown(self):
+        chroot.end_overlay()
+        chroot.set_overlay(False)
+        self.tmp.cleanup()
+
+    def _begin(self):
+        self.assertTrue(chroot.begin_overlay(self.pkg))
+        self.upper = chroot.overlay_upper()
+
+    def test_overlay_dep_version(self):
+        self._begin()
+
+        _write_db(self.upper, "1.0-r0")
+        old = fingerprint.compute(self.pkg)
+
+        # the dependency was updated in the overlay only
+        _write_db(self.upper, "2.0-r0")
+        new = fingerprint.compute(self.pkg)
+
+        self.assertNotEqual(old, new)
+
+    def test_overlay_is_used(self):
+        base = fingerprint.compute(self.pkg)
+
+        self._begin()
+        _write_db(self.upper, "2.0-r0")
+
+        self.assertNotEqual(base, fingerprint.compute(self.pkg))
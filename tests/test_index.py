@@ -0,0 +1,37 @@
+import unittest
+
+from cbuild.apk import index
+
+def _db(*ents):
+    db = index.Database()
+    for ent in ents:
+        db.add(ent)
+    return db
+
+class FindAvailableTest(unittest.TestCase):
+    def setUp(self):
+        self.dbs = []
+        self.orig = index.repositories
+        index.repositories = lambda mrepo, arch = None: self.dbs
+
+    def tearDown(self):
+        index.repositories = self.orig
+
+    def test_provided_version(self):
+        self.dbs = [_db({"P": "foo", "V": "5.0-r0", "p": "bar=1.0"})]
+        self.assertEqual(index.find_available("bar", None, None), "1.0")
+        self.assertEqual(index.find_available("bar", "bar<2", None), "1.0")
+        # the providing package version must not be matched against
+        self.assertIsNone(index.find_available("bar", "bar>=5", None))
+
+    def test_unversioned_provider(self):
+        self.dbs = [_db({"P": "foo", "V": "5.0-r0", "p": "bar"})]
+        self.assertEqual(index.find_available("bar", None, None), "5.0-r0")
+        self.assertIsNone(index.find_available("bar", "bar>=1", None))
+
+    def test_name_preferred(self):
+        self.dbs = [_db(
+            {"P": "bar", "V": "3.0-r0"},
+            {"P": "foo", "V": "5.0-r0", "p": "bar=9.0"},
+        )]
+        self.assertEqual(index.find_available("bar", "bar>=1", None), "3.0-r0")
@@ -0,0 +1,85 @@
+import pathlib
+import tempfile
+import importlib.util
+import subprocess
+import types
+import unittest
+
+_hook = pathlib.Path(__file__).resolve().parent.parent / \
+    "cbuild/hooks/post_install/06_strip_and_debug_pkgs.py"
+
+_spec = importlib.util.spec_from_file_location("strip_hook", _hook)
+strip_hook = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(strip_hook)
+
+# fails for any file with "bad" in its name
+_strip = """#!/bin/sh
+for a; do
+    case "$a" in *bad*) exit 1 ;; esac
+done
+"""
+
+class _Error(Exception):
+    pass
+
+class _Parent:
+    conf_jobs = 2
+
+    def __init__(self, root):
+        self.builddir = root / "builddir"
+        self.chroot_builddir = self.builddir
+        self.statedir = self.builddir / ".cbuild-state"
+        self.statedir.mkdir(parents = True)
+
+    def get_tool(self, name):
+        return "objcopy"
+
+    # the same as a bootstrap build, i.e. not sandboxed
+    def do(self, cmd, args, stdout = None):
+        return subprocess.run(
+            [cmd] + [str(a) for a in args], stdout = stdout, check = True
+        )
+
+class _Package:
+    pkgname = "foo"
+
+    def __init__(self, root):
+        self.rparent = _Parent(root)
+        self.destdir = root / "destdir"
+        self.chroot_destdir = self.destdir
+        (self.destdir / "usr/lib").mkdir(parents = True)
+
+    def error(self, msg):
+        raise _Error(msg)
+
+class RunTasksTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = pathlib.Path(self.tmp.name)
+        self.pkg = _Package(root)
+        self.strip = root / "strip"
+        self.strip.write_text(_strip)
+        self.strip.chmod(0o755)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _tasks(self, *names):
+        ret = []
+        for n in names:
+            vr = pathlib.Path("usr/lib") / n
+            (self.pkg.destdir / vr).write_bytes(b"")
+            ret.append(("static", vr, False, f"Stripped static library: {vr}"))
+        return ret
+
+    def test_success(self):
+        strip_hook.run_tasks(
+            self.pkg, self.strip, self._tasks("liba.a", "libb.a")
+        )
+        self.assertEqual(list(self.pkg.rparent.statedir.iterdir()), [])
+
+    def test_failure_names_file(self):
+        tasks = self._tasks("liba.a", "libbad.a", "libc.a")
+        with self.assertRaises(_Error) as cm:
+            strip_hook.run_tasks(self.pkg, self.strip, tasks)
+        self.assertEqual(str(cm.exception), "failed to strip usr/lib/libbad.a")